@@ -7,7 +7,10 @@
 
 
 """
-Usage: gn_to_cmake.py <json_file_name>
+Usage: gn_to_cmake.py [--jobs N] [--stats] [--streaming] [--incremental]
+                      [--roots LABELS] [--filter PATTERNS]
+                      [--format {cmake,compile_commands}] [--cc CC] [--cxx CXX]
+                      <json_file_name>
 
 gn gen out/config --ide=json --json-ide-script=../../gn/gn_to_cmake.py
 
@@ -20,13 +23,20 @@ The first is recommended, as it will auto-update.
 """
 
 
+import argparse
+import collections
+import fnmatch
 import itertools
 import functools
+import hashlib
 import json
+import multiprocessing
 import posixpath
 import os
+import re
 import string
 import sys
+import time
 
 
 def CMakeStringEscape(a):
@@ -43,18 +53,32 @@ def CMakeStringEscape(a):
   return a.replace('\\', '\\\\').replace(';', '\\;').replace('"', '\\"')
 
 
+class CMakeTargetEscapeTable(dict):
+  """A str.translate table mapping characters invalid in target names to '__'.
+
+  Entries are filled in on first use, so any code point can be looked up.
+  """
+  valid_code_points = frozenset(
+      ord(c) for c in string.ascii_letters + string.digits + '_.+-')
+
+  def __missing__(self, code_point):
+    value = code_point if code_point in self.valid_code_points else u'__'
+    self[code_point] = value
+    return value
+
+
+cmake_target_escape_table = CMakeTargetEscapeTable()
+
+
 def CMakeTargetEscape(a):
   """Escapes the string 'a' for use as a CMake target name.
 
   CMP0037 in CMake 3.0 restricts target names to "^[A-Za-z0-9_.:+-]+$"
   The ':' is only allowed for imported targets.
   """
-  def Escape(c):
-    if c in string.ascii_letters or c in string.digits or c in '_.+-':
-      return c
-    else:
-      return '__'
-  return ''.join(map(Escape, a))
+  if isinstance(a, bytes):
+    a = a.decode('utf-8')
+  return a.translate(cmake_target_escape_table)
 
 
 def SetVariable(out, variable_name, value):
@@ -155,6 +179,234 @@ def FindFirstOf(s, a):
   return min(s.find(i) for i in a if i in s)
 
 
+# A gn label split into its parts, along with the CMake target name it maps to.
+GnLabel = collections.namedtuple(
+    'GnLabel', ['location', 'name', 'toolchain', 'cmake_name'])
+
+
+def ParseLabel(gn_target_name):
+  """Parses a fully qualified gn label into a GnLabel."""
+  # See <chromium>/src/tools/gn/label.cc#Resolve
+  # //base/test:test_support(//build/toolchain/win:msvc)
+  location = None
+  name = None
+  toolchain = None
+  if ':' not in gn_target_name and '(' not in gn_target_name:
+    location = gn_target_name[2:]
+  else:
+    path_separator = FindFirstOf(gn_target_name, (':', '('))
+    location = gn_target_name[2:path_separator]
+    toolchain_separator = gn_target_name.find('(', path_separator)
+    if toolchain_separator == -1:
+      name = gn_target_name[path_separator + 1:]
+    else:
+      if toolchain_separator > path_separator:
+        name = gn_target_name[path_separator + 1:toolchain_separator]
+      assert gn_target_name.endswith(')')
+      toolchain = gn_target_name[toolchain_separator + 1:-1]
+  assert location or name
+
+  cmake_target_name = None
+  if not name or location.endswith('/' + name):
+    cmake_target_name = location
+  elif location:
+    cmake_target_name = location + '_' + name
+  else:
+    cmake_target_name = name
+  if toolchain:
+    cmake_target_name += '--' + toolchain
+  return GnLabel(location, name, toolchain,
+                 CMakeTargetEscape(cmake_target_name))
+
+
+# The target properties read by WriteTarget and its helpers. When streaming,
+# everything else in a target's description is dropped as soon as it is parsed.
+target_fields = (
+  'type',
+  'deps',
+  'sources',
+  'inputs',
+  'outputs',
+  'script',
+  'args',
+  'include_dirs',
+  'defines',
+  'cflags',
+  'cflags_c',
+  'cflags_cc',
+  'asmflags',
+  'ldflags',
+  'libs',
+  'lib_dirs',
+)
+
+
+class JsonStreamReader(object):
+  """Reads a large JSON document from a file one value at a time.
+
+  Only the data currently being decoded is kept in memory, so members of a
+  huge top-level object can be processed before the rest of the file has
+  been read.
+  """
+  chunk_size = 1 << 20
+  whitespace = re.compile(r'[ \t\n\r]*')
+
+  def __init__(self, stream):
+    self.stream = stream
+    self.buffer = ''
+    self.position = 0
+    self.eof = False
+    self.decoder = json.JSONDecoder()
+
+  def _Fill(self):
+    """Reads another chunk, dropping what has already been consumed."""
+    if self.eof:
+      return False
+    chunk = self.stream.read(self.chunk_size)
+    if not chunk:
+      self.eof = True
+      return False
+    self.buffer = self.buffer[self.position:] + chunk
+    self.position = 0
+    return True
+
+  def _SkipWhitespace(self):
+    while True:
+      self.position = self.whitespace.match(self.buffer, self.position).end()
+      if self.position < len(self.buffer) or not self._Fill():
+        return
+
+  def Peek(self):
+    """Returns the next non-whitespace character, or '' at the end."""
+    self._SkipWhitespace()
+    return self.buffer[self.position:self.position + 1]
+
+  def Expect(self, token):
+    if self.Peek() != token:
+      raise ValueError('Expected %r at offset %d of the JSON buffer' %
+                       (token, self.position))
+    self.position += 1
+
+  def ReadValue(self):
+    """Decodes the next complete JSON value."""
+    self._SkipWhitespace()
+    while True:
+      try:
+        value, end = self.decoder.raw_decode(self.buffer, self.position)
+        # A number may continue past the end of the buffer.
+        if end < len(self.buffer) or self.eof:
+          self.position = end
+          return value
+      except ValueError:
+        if self.eof:
+          raise
+      self._Fill()
+
+  def IterObject(self):
+    """Yields the keys of the next JSON object.
+
+    The caller must consume each key's value, with ReadValue or IterObject,
+    before advancing the iterator.
+    """
+    self.Expect('{')
+    if self.Peek() == '}':
+      self.position += 1
+      return
+    while True:
+      key = self.ReadValue()
+      self.Expect(':')
+      yield key
+      if self.Peek() == ',':
+        self.position += 1
+        continue
+      self.Expect('}')
+      return
+
+
+def CompactTarget(properties, labels):
+  """Keeps the properties WriteTarget uses and shares repeated labels."""
+  target = {}
+  for field in target_fields:
+    if field in properties:
+      target[field] = properties[field]
+  if 'deps' in target:
+    target['deps'] = [labels.setdefault(dependency, dependency)
+                      for dependency in target['deps']]
+  return target
+
+
+def LoadProjectStreaming(json_file):
+  """Parses project.json incrementally into compact per-target records.
+
+  Unlike json.load, the raw text is never held in memory as a whole and each
+  target is reduced to the fields in target_fields as soon as it is decoded.
+  """
+  reader = JsonStreamReader(json_file)
+  project_json = {'targets': {}}
+  labels = {}
+  for key in reader.IterObject():
+    if key != 'targets':
+      project_json[key] = reader.ReadValue()
+      continue
+    targets = project_json['targets']
+    for gn_target_name in reader.IterObject():
+      gn_target_name = labels.setdefault(gn_target_name, gn_target_name)
+      targets[gn_target_name] = CompactTarget(reader.ReadValue(), labels)
+  return project_json
+
+
+class ObjectDependencyIndex(object):
+  """Transitive OBJECT library closures for every target in a Project.
+
+  The closures are computed once, bottom up, with an explicit stack so that
+  deep source_set chains neither re-walk shared subgraphs nor run into the
+  interpreter recursion limit. Targets with empty closures share one empty
+  frozenset.
+  """
+  def __init__(self, targets):
+    self.sources = {}
+    self.libraries = {}
+    self.edge_count = 0
+    empty = frozenset()
+
+    def GetType(gn_target_name):
+      return targets.get(gn_target_name, {}).get('type', None)
+
+    def GetDeps(gn_target_name):
+      return targets.get(gn_target_name, {}).get('deps', [])
+
+    for root in targets:
+      if root in self.sources:
+        continue
+      stack = [(root, False)]
+      while stack:
+        gn_target_name, expanded = stack.pop()
+        if gn_target_name in self.sources:
+          continue
+        dependencies = GetDeps(gn_target_name)
+        if not expanded:
+          stack.append((gn_target_name, True))
+          for dependency in dependencies:
+            if dependency not in self.sources:
+              stack.append((dependency, False))
+          continue
+
+        self.edge_count += len(dependencies)
+        sources = set()
+        libraries = set()
+        for dependency in dependencies:
+          dependency_type = GetType(dependency)
+          if dependency_type == 'source_set':
+            sources.add(dependency)
+            libraries.add(dependency)
+            libraries.update(self.libraries[dependency])
+          if dependency_type not in gn_target_types_that_absorb_objects:
+            sources.update(self.sources[dependency])
+        self.sources[gn_target_name] = frozenset(sources) if sources else empty
+        self.libraries[gn_target_name] = (
+            frozenset(libraries) if libraries else empty)
+
+
 class Project(object):
   def __init__(self, project_json):
     self.targets = project_json['targets']
@@ -162,6 +414,11 @@ class Project(object):
     self.root_path = build_settings['root_path']
     self.build_path = posixpath.join(self.root_path,
                                      build_settings['build_dir'][2:])
+    self._object_index = None
+    self._labels = {}
+    self.closure_time = None
+    self.fragments_rewritten = None
+    self.fragments_total = None
 
   def GetAbsolutePath(self, path):
     if path.startswith("//"):
@@ -169,56 +426,77 @@ class Project(object):
     else:
       return path
 
+  def GetObjectIndex(self):
+    """Returns the ObjectDependencyIndex, computing it on first use."""
+    if self._object_index is None:
+      start = time.time()
+      self._object_index = ObjectDependencyIndex(self.targets)
+      self.closure_time = time.time() - start
+    return self._object_index
+
   def GetObjectSourceDependencies(self, gn_target_name, object_dependencies):
     """All OBJECT libraries whose sources have not been absorbed."""
-    dependencies = self.targets[gn_target_name].get('deps', [])
-    for dependency in dependencies:
-      dependency_type = self.targets[dependency].get('type', None)
-      if dependency_type == 'source_set':
-        object_dependencies.add(dependency)
-      if dependency_type not in gn_target_types_that_absorb_objects:
-        self.GetObjectSourceDependencies(dependency, object_dependencies)
+    object_dependencies.update(
+        self.GetObjectIndex().sources.get(gn_target_name, ()))
 
   def GetObjectLibraryDependencies(self, gn_target_name, object_dependencies):
     """All OBJECT libraries whose libraries have not been absorbed."""
-    dependencies = self.targets[gn_target_name].get('deps', [])
-    for dependency in dependencies:
-      dependency_type = self.targets[dependency].get('type', None)
-      if dependency_type == 'source_set':
-        object_dependencies.add(dependency)
-        self.GetObjectLibraryDependencies(dependency, object_dependencies)
+    object_dependencies.update(
+        self.GetObjectIndex().libraries.get(gn_target_name, ()))
+
+  def GetTargetHash(self, gn_target_name):
+    """Hashes everything WriteTarget reads when emitting the given target.
+
+    This covers the target's own properties, the types of the targets it
+    depends on (including those pulled in through OBJECT libraries) and its
+    OBJECT library closures.
+    """
+    properties = self.targets[gn_target_name]
+    object_sources = set()
+    object_libraries = set()
+    self.GetObjectSourceDependencies(gn_target_name, object_sources)
+    self.GetObjectLibraryDependencies(gn_target_name, object_libraries)
+    dependencies = set(properties.get('deps', []))
+    for object_dependency in object_libraries:
+      dependencies.update(self.targets[object_dependency].get('deps', []))
+    dependency_types = [
+        (dependency, self.targets.get(dependency, {}).get('type', None))
+        for dependency in sorted(dependencies)]
+    state = [self.root_path, self.build_path, properties, dependency_types,
+             sorted(object_sources), sorted(object_libraries)]
+    return hashlib.sha1(json.dumps(state, sort_keys=True)
+                        .encode('utf-8')).hexdigest()
+
+  def SelectTargets(self, roots):
+    """Drops every target which is not one of roots or one of their deps.
+
+    OBJECT libraries absorbed by the remaining targets are dependencies and so
+    are kept, and the closures computed on the slice are the same as on the
+    full graph.
+    """
+    selected = set()
+    stack = list(roots)
+    while stack:
+      gn_target_name = stack.pop()
+      if gn_target_name in selected or gn_target_name not in self.targets:
+        continue
+      selected.add(gn_target_name)
+      stack.extend(self.targets[gn_target_name].get('deps', []))
+    self.targets = dict((gn_target_name, properties)
+                        for gn_target_name, properties in self.targets.items()
+                        if gn_target_name in selected)
+    self._object_index = None
+
+  def GetLabel(self, gn_target_name):
+    """Returns the GnLabel for a label, parsing each distinct label once."""
+    label = self._labels.get(gn_target_name)
+    if label is None:
+      label = ParseLabel(gn_target_name)
+      self._labels[gn_target_name] = label
+    return label
 
   def GetCMakeTargetName(self, gn_target_name):
-    # See <chromium>/src/tools/gn/label.cc#Resolve
-    # //base/test:test_support(//build/toolchain/win:msvc)
-    path_separator = FindFirstOf(gn_target_name, (':', '('))
-    location = None
-    name = None
-    toolchain = None
-    if not path_separator:
-      location = gn_target_name[2:]
-    else:
-      location = gn_target_name[2:path_separator]
-      toolchain_separator = gn_target_name.find('(', path_separator)
-      if toolchain_separator == -1:
-        name = gn_target_name[path_separator + 1:]
-      else:
-        if toolchain_separator > path_separator:
-          name = gn_target_name[path_separator + 1:toolchain_separator]
-        assert gn_target_name.endswith(')')
-        toolchain = gn_target_name[toolchain_separator + 1:-1]
-    assert location or name
-
-    cmake_target_name = None
-    if location.endswith('/' + name):
-      cmake_target_name = location
-    elif location:
-      cmake_target_name = location + '_' + name
-    else:
-      cmake_target_name = name
-    if toolchain:
-      cmake_target_name += '--' + toolchain
-    return CMakeTargetEscape(cmake_target_name)
+    return self.GetLabel(gn_target_name).cmake_name
 
 
 class Target(object):
@@ -248,7 +526,7 @@ def WriteAction(out, target, project, sources, synthetic_dependencies):
 
   if output_directories:
     out.write('  COMMAND ${CMAKE_COMMAND} -E make_directory "')
-    out.write('" "'.join(map(CMakeStringEscape, output_directories)))
+    out.write('" "'.join(map(CMakeStringEscape, sorted(output_directories))))
     out.write('"\n')
 
   script = target.properties['script']
@@ -295,7 +573,7 @@ def WriteActionForEach(out, target, project, sources, synthetic_dependencies):
   all_outputs = target.properties.get('outputs', [])
   inputs = target.properties.get('sources', [])
   # TODO: consider expanding 'output_patterns' instead.
-  outputs_per_input = len(all_outputs) / len(inputs)
+  outputs_per_input = len(all_outputs) // len(inputs)
   for count, source in enumerate(inputs):
     source_abs_path = project.GetAbsolutePath(source)
 
@@ -317,7 +595,7 @@ def WriteActionForEach(out, target, project, sources, synthetic_dependencies):
 
     if output_directories:
       out.write('  COMMAND ${CMAKE_COMMAND} -E make_directory "')
-      out.write('" "'.join(map(CMakeStringEscape, output_directories)))
+      out.write('" "'.join(map(CMakeStringEscape, sorted(output_directories))))
       out.write('"\n')
 
     script = target.properties['script']
@@ -475,7 +753,7 @@ def WriteSourceVariables(out, target, project):
   source_types = {'cxx':[], 'c':[], 'asm':[],
                   'obj':[], 'obj_target':[], 'input':[], 'other':[]}
 
-  all_sources = target.properties.get('sources', [])
+  all_sources = list(target.properties.get('sources', []))
 
   # As of cmake 3.11 add_library must have sources. If there are
   # no sources, add empty.cpp as the file to compile.
@@ -498,7 +776,7 @@ def WriteSourceVariables(out, target, project):
   if target.gn_type in gn_target_types_that_absorb_objects:
     object_dependencies = set()
     project.GetObjectSourceDependencies(target.gn_name, object_dependencies)
-    for dependency in object_dependencies:
+    for dependency in sorted(object_dependencies):
       cmake_dependency_name = project.GetCMakeTargetName(dependency)
       obj_target_sources = '$<TARGET_OBJECTS:' + cmake_dependency_name + '>'
       source_types['obj_target'].append(obj_target_sources)
@@ -542,7 +820,7 @@ def WriteTarget(out, target, project):
     WriteVariable(out, sources_type_name, ' ')
   if synthetic_dependencies:
     out.write(' DEPENDS')
-    for synthetic_dependencie in synthetic_dependencies:
+    for synthetic_dependencie in sorted(synthetic_dependencies):
       WriteVariable(out, synthetic_dependencie, ' ')
   out.write(')\n')
 
@@ -577,7 +855,7 @@ def WriteTarget(out, target, project):
   # Non-library dependencies.
   if nonlibraries:
     out.write('add_dependencies("${target}"')
-    for nonlibrary in nonlibraries:
+    for nonlibrary in sorted(nonlibraries):
       out.write('\n  "')
       out.write(nonlibrary)
       out.write('"')
@@ -612,7 +890,7 @@ def WriteTarget(out, target, project):
         out.write(')\n')
         system_libraries.append(system_library)
     out.write('target_link_libraries("${target}"')
-    for library in libraries:
+    for library in sorted(libraries):
       out.write('\n  "')
       out.write(CMakeStringEscape(library))
       out.write('"')
@@ -622,37 +900,97 @@ def WriteTarget(out, target, project):
     out.write(')\n')
 
 
-def WriteProject(project):
-  out = open(posixpath.join(project.build_path, 'CMakeLists.txt'), 'w+')
-  extName = posixpath.join(project.build_path, 'CMakeLists.ext')
-  out.write('# Generated by gn_to_cmake.py.\n')
-  out.write('cmake_minimum_required(VERSION 2.8.8 FATAL_ERROR)\n')
-  out.write('cmake_policy(VERSION 2.8.8)\n\n')
+class CMakeEmitter(object):
+  """Accumulates generated CMake text and writes it out in a single write.
 
-  out.write('file(WRITE "')
-  out.write(CMakeStringEscape(posixpath.join(project.build_path, "empty.cpp")))
-  out.write('")\n')
+  The helpers above issue many small writes; collecting them here means a
+  file is written with one system call. Commit replaces the file through a
+  temporary file and a rename, so readers never see a partial file, and
+  leaves it untouched when its contents have not changed, so that file
+  watchers are not triggered needlessly.
+  """
+  def __init__(self, path=None):
+    self.path = path
+    self.fragments = []
+
+  def write(self, text):
+    self.fragments.append(text)
+
+  def getvalue(self):
+    return ''.join(self.fragments)
+
+  def Commit(self):
+    """Writes the accumulated text to self.path.
+
+    Returns True if the file was written, False if it was already up to date.
+    """
+    content = self.getvalue()
+    if not isinstance(content, bytes):
+      content = content.encode('utf-8')
+    try:
+      with open(self.path, 'rb') as existing:
+        if existing.read() == content:
+          return False
+    except (IOError, OSError):
+      pass
+    temp_path = self.path + '.tmp'
+    with open(temp_path, 'wb') as temp_file:
+      temp_file.write(content)
+    os.rename(temp_path, self.path)
+    return True
+
+
+def RenderTargets(project, target_names):
+  """Returns the CMake text for the given targets, in order."""
+  out = CMakeEmitter()
+  for target_name in target_names:
+    out.write('\n')
+    WriteTarget(out, Target(target_name, project), project)
+  return out.getvalue()
 
-  # Update the gn generated ninja build.
-  # If a build file has changed, this will update CMakeLists.ext if
-  # gn gen out/config --ide=json --json-ide-script=../../gn/gn_to_cmake.py
-  # style was used to create this config.
-  out.write('execute_process(COMMAND\n')
-  out.write('  ninja -C "')
-  out.write(CMakeStringEscape(project.build_path))
-  out.write('" build.ninja\n')
-  out.write('  RESULT_VARIABLE ninja_result)\n')
-  out.write('if (ninja_result)\n')
-  out.write('  message(WARNING ')
-  out.write('"Regeneration failed running ninja: ${ninja_result}")\n')
-  out.write('endif()\n')
 
-  out.write('include("')
-  out.write(CMakeStringEscape(extName))
-  out.write('")\n')
-  out.close()
+# The Project rendered by the current worker process, see RenderTargetsInPool.
+_worker_project = None
+
+
+def _InitWorker(project):
+  global _worker_project
+  _worker_project = project
+
+
+def _RenderTargetsInWorker(target_names):
+  return RenderTargets(_worker_project, target_names)
+
+
+def RenderTargetsInPool(project, target_name_lists, jobs):
+  """Renders each list of targets, yielding the results in the given order.
 
-  out = open(extName, 'w+')
+  With more than one job the lists are rendered by a pool of worker
+  processes, each holding its own copy of the project.
+  """
+  if jobs <= 1:
+    for target_names in target_name_lists:
+      yield RenderTargets(project, target_names)
+    return
+  # Compute the closures once, before the project is handed to the workers.
+  project.GetObjectIndex()
+  pool = multiprocessing.Pool(jobs, _InitWorker, (project,))
+  try:
+    for text in pool.imap(_RenderTargetsInWorker, target_name_lists):
+      yield text
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+
+
+# Number of targets given to a worker at a time.
+targets_per_job = 256
+
+
+def WriteProjectHeader(out, project):
   out.write('# Generated by gn_to_cmake.py.\n')
   out.write('cmake_minimum_required(VERSION 2.8.8 FATAL_ERROR)\n')
   out.write('cmake_policy(VERSION 2.8.8)\n')
@@ -691,22 +1029,276 @@ def WriteProject(project):
   out.write('  configure_file("${other_dep}" "CMakeLists.devnull" COPYONLY)\n')
   out.write('endforeach("other_dep")\n')
 
-  for target_name in project.targets.keys():
+
+# Bump when the layout of the incremental cache or fragments changes.
+incremental_cache_version = 1
+
+
+def GetGeneratorHash():
+  """Hashes this script, so that editing it invalidates all fragments."""
+  with open(os.path.abspath(__file__), 'rb') as script:
+    return hashlib.sha1(script.read()).hexdigest()
+
+
+def LoadIncrementalCache(cache_path, generator_hash):
+  """Returns the fragment hashes of the previous run, if still usable."""
+  try:
+    with open(cache_path, 'r') as cache_file:
+      cache = json.load(cache_file)
+  except (IOError, OSError, ValueError):
+    return {}
+  if (cache.get('version') != incremental_cache_version or
+      cache.get('generator') != generator_hash):
+    return {}
+  return cache.get('fragments', {})
+
+
+def WriteFragments(out, project, jobs=1):
+  """Writes one .cmake fragment per gn directory and includes them all.
+
+  A fragment is only rewritten when the hash of the targets it contains
+  differs from the one recorded in the sidecar cache by the previous run.
+  """
+  fragments_path = posixpath.join(project.build_path, 'CMakeLists.fragments')
+  cache_path = posixpath.join(project.build_path, 'CMakeLists.cache.json')
+  if not os.path.isdir(fragments_path):
+    os.makedirs(fragments_path)
+
+  # Targets are kept sorted within their fragment so that its hash and text
+  # don't depend on dict order.
+  fragments = {}
+  for target_name in sorted(project.targets):
+    fragment_name = CMakeTargetEscape(
+        project.GetLabel(target_name).location) or '__'
+    fragments.setdefault(fragment_name + '.cmake', []).append(target_name)
+
+  generator_hash = GetGeneratorHash()
+  previous_hashes = LoadIncrementalCache(cache_path, generator_hash)
+  hashes = {}
+  changed = []
+  for fragment_name in sorted(fragments):
+    fragment_hash = hashlib.sha1()
+    for target_name in fragments[fragment_name]:
+      fragment_hash.update(target_name.encode('utf-8'))
+      fragment_hash.update(project.GetTargetHash(target_name).encode('utf-8'))
+    hashes[fragment_name] = fragment_hash.hexdigest()
+
+    fragment_path = posixpath.join(fragments_path, fragment_name)
+    if (previous_hashes.get(fragment_name) != hashes[fragment_name] or
+        not os.path.exists(fragment_path)):
+      changed.append(fragment_name)
+
+    out.write('include("')
+    out.write(CMakeStringEscape(fragment_path))
+    out.write('")\n')
+
+  rendered = RenderTargetsInPool(
+      project, [fragments[fragment_name] for fragment_name in changed], jobs)
+  for text, fragment_name in zip(rendered, changed):
+    fragment = CMakeEmitter(posixpath.join(fragments_path, fragment_name))
+    fragment.write('# Generated by gn_to_cmake.py.\n')
+    fragment.write(text)
+    fragment.Commit()
+
+  # Remove fragments for directories which no longer have targets.
+  for fragment_name in os.listdir(fragments_path):
+    if fragment_name.endswith('.cmake') and fragment_name not in fragments:
+      os.remove(posixpath.join(fragments_path, fragment_name))
+
+  cache = CMakeEmitter(cache_path)
+  cache.write(json.dumps({
+      'version': incremental_cache_version,
+      'generator': generator_hash,
+      'fragments': hashes,
+  }, indent=2, sort_keys=True))
+  cache.Commit()
+  project.fragments_rewritten = len(changed)
+  project.fragments_total = len(fragments)
+
+
+def WriteProject(project, incremental=False, jobs=1):
+  out = CMakeEmitter(posixpath.join(project.build_path, 'CMakeLists.txt'))
+  extName = posixpath.join(project.build_path, 'CMakeLists.ext')
+  out.write('# Generated by gn_to_cmake.py.\n')
+  out.write('cmake_minimum_required(VERSION 2.8.8 FATAL_ERROR)\n')
+  out.write('cmake_policy(VERSION 2.8.8)\n\n')
+
+  out.write('file(WRITE "')
+  out.write(CMakeStringEscape(posixpath.join(project.build_path, "empty.cpp")))
+  out.write('")\n')
+
+  # Update the gn generated ninja build.
+  # If a build file has changed, this will update CMakeLists.ext if
+  # gn gen out/config --ide=json --json-ide-script=../../gn/gn_to_cmake.py
+  # style was used to create this config.
+  out.write('execute_process(COMMAND\n')
+  out.write('  ninja -C "')
+  out.write(CMakeStringEscape(project.build_path))
+  out.write('" build.ninja\n')
+  out.write('  RESULT_VARIABLE ninja_result)\n')
+  out.write('if (ninja_result)\n')
+  out.write('  message(WARNING ')
+  out.write('"Regeneration failed running ninja: ${ninja_result}")\n')
+  out.write('endif()\n')
+
+  out.write('include("')
+  out.write(CMakeStringEscape(extName))
+  out.write('")\n')
+  out.Commit()
+
+  out = CMakeEmitter(extName)
+  WriteProjectHeader(out, project)
+
+  if incremental:
     out.write('\n')
-    WriteTarget(out, Target(target_name, project), project)
+    WriteFragments(out, project, jobs)
+  else:
+    target_names = list(project.targets.keys())
+    chunks = [target_names[i:i + targets_per_job]
+              for i in range(0, len(target_names), targets_per_job)]
+    for text in RenderTargetsInPool(project, chunks, jobs):
+      out.write(text)
+  out.Commit()
 
 
-def main():
-  if len(sys.argv) != 2:
-    print('Usage: ' + sys.argv[0] + ' <json_file_name>')
-    exit(1)
+compiled_target_types = gn_target_types_that_absorb_objects + ('source_set',)
+
+# The gn source types which are compiled, and the flags that apply to them.
+compiled_source_flags = {
+  'c': ('cflags', 'cflags_c'),
+  'cxx': ('cflags', 'cflags_cc'),
+  'asm': ('asmflags',),
+}
+
+
+def WriteCompilationDatabase(project, cc, cxx):
+  """Writes compile_commands.json straight from the gn target properties.
+
+  Entries are written to disk as each target is visited rather than built
+  up in memory, and CMake is not involved at all.
+  """
+  database_path = posixpath.join(project.build_path, 'compile_commands.json')
+  temp_path = database_path + '.tmp'
+  compilers = {'c': cc, 'cxx': cxx, 'asm': cc}
+  separator = '\n'
+  with open(temp_path, 'w') as database:
+    database.write('[')
+    for target_name in project.targets.keys():
+      properties = project.targets[target_name]
+      if properties.get('type', None) not in compiled_target_types:
+        continue
+      common_arguments = []
+      for define in properties.get('defines', []):
+        common_arguments.append('-D' + define)
+      for include_dir in properties.get('include_dirs', []):
+        common_arguments.append('-I' + project.GetAbsolutePath(include_dir))
+      for source in properties.get('sources', []):
+        _, ext = posixpath.splitext(source)
+        source_type = source_file_types.get(ext, None)
+        if source_type not in compiled_source_flags:
+          continue
+        source_abs_path = project.GetAbsolutePath(source)
+        arguments = [compilers[source_type]]
+        for flags in compiled_source_flags[source_type]:
+          arguments.extend(properties.get(flags, []))
+        arguments.extend(common_arguments)
+        arguments.extend(['-c', source_abs_path])
+        database.write(separator)
+        database.write(json.dumps({
+          'directory': project.build_path,
+          'file': source_abs_path,
+          'arguments': arguments,
+        }, sort_keys=True))
+        separator = ',\n'
+    database.write('\n]\n')
+  os.rename(temp_path, database_path)
+
+
+def FindRoots(project, roots, filters):
+  """Returns the targets named in roots or matching one of the filters.
+
+  Exits with an error if a root is not a target or a filter matches nothing.
+  """
+  selected = []
+  for root in roots:
+    if root not in project.targets:
+      print('Error: unknown root target %s' % root)
+      sys.exit(1)
+    selected.append(root)
+  for pattern in filters:
+    matches = fnmatch.filter(project.targets.keys(), pattern)
+    if not matches:
+      print('Error: no target matches %s' % pattern)
+      sys.exit(1)
+    selected.extend(matches)
+  return selected
+
+
+def WriteStats(project, elapsed):
+  """Prints the size of the dependency graph and where time was spent."""
+  index = project.GetObjectIndex()
+  print('gn_to_cmake: %d targets, %d dependency edges' %
+        (len(project.targets), index.edge_count))
+  print('gn_to_cmake: object closures computed in %.3fs' %
+        project.closure_time)
+  if project.fragments_total is not None:
+    print('gn_to_cmake: rewrote %d of %d fragments' %
+          (project.fragments_rewritten, project.fragments_total))
+  print('gn_to_cmake: generated in %.3fs' % elapsed)
+
 
-  json_path = sys.argv[1]
+def main():
+  parser = argparse.ArgumentParser(
+      description='Generates CMakeLists.txt from a gn project.json file')
+  parser.add_argument('json_path', metavar='json_file_name',
+                      help='Path to the project.json file written by gn')
+  parser.add_argument('--jobs', '-j', type=int, default=1,
+                      help='Number of processes rendering targets')
+  parser.add_argument('--stats', action='store_true',
+                      help='Print dependency graph size and timings')
+  parser.add_argument('--streaming', action='store_true',
+                      help='Parse project.json incrementally, keeping only '
+                           'the target properties that are used')
+  parser.add_argument('--incremental', action='store_true',
+                      help='Write one fragment per gn directory and only '
+                           'rewrite the fragments whose targets changed')
+  parser.add_argument('--format', choices=('cmake', 'compile_commands'),
+                      default='cmake',
+                      help='Write CMake files, or only compile_commands.json')
+  parser.add_argument('--cc', default='clang',
+                      help='C compiler named in compile_commands.json')
+  parser.add_argument('--cxx', default='clang++',
+                      help='C++ compiler named in compile_commands.json')
+  parser.add_argument('--roots', action='append', default=[],
+                      help='Comma-separated labels of the targets to emit, '
+                           'along with their transitive dependencies')
+  parser.add_argument('--filter', action='append', default=[],
+                      help='Comma-separated label patterns, e.g. '
+                           '//garnet/*, of the targets to emit along with '
+                           'their transitive dependencies')
+  args = parser.parse_args()
+
+  start = time.time()
   project = None
-  with open(json_path, 'r') as json_file:
-    project = json.loads(json_file.read())
+  with open(args.json_path, 'r') as json_file:
+    if args.streaming:
+      project = Project(LoadProjectStreaming(json_file))
+    else:
+      project = Project(json.loads(json_file.read()))
+
+  roots = [root for roots in args.roots for root in roots.split(',') if root]
+  filters = [pattern for patterns in args.filter
+             for pattern in patterns.split(',') if pattern]
+  if roots or filters:
+    project.SelectTargets(FindRoots(project, roots, filters))
+
+  if args.format == 'compile_commands':
+    WriteCompilationDatabase(project, args.cc, args.cxx)
+  else:
+    WriteProject(project, incremental=args.incremental, jobs=args.jobs)
 
-  WriteProject(Project(project))
+  if args.stats:
+    WriteStats(project, time.time() - start)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 The Fuchsia Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+
+"""
+Usage: gn_to_cmake_benchmark.py [--components N] [--depth N] [--fanout N]
+                                [--links N] [--jobs N] [--streaming]
+                                [--incremental] [--keep DIR]
+
+Benchmarks gn_to_cmake.py against a synthetic gn project.json file.
+
+The generated graph is made of components. Each component has an
+action_foreach generating sources, a chain of source_sets on top of it, and
+a static_library and an executable on top of the chain. Each executable also
+links the libraries of a few earlier components.
+
+The time, throughput and peak memory of loading project.json, building the
+Project, computing the OBJECT library closures and writing the CMake files
+are reported.
+"""
+
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import gn_to_cmake
+
+
+def GenerateProject(root_path, components, depth, fanout, links, seed):
+  """Returns a synthetic project.json dictionary."""
+  rng = random.Random(seed)
+  targets = {}
+  libraries = []
+  for component in range(components):
+    directory = 'src/component%d' % component
+    def Label(name):
+      return '//%s:%s' % (directory, name)
+    common = {
+      'include_dirs': ['//%s/include' % directory, '//out/gen'],
+      'defines': ['COMPONENT=%d' % component],
+      'cflags': ['-O2', '-Wall'],
+      'cflags_c': ['-std=c11'],
+      'cflags_cc': ['-std=c++14'],
+    }
+
+    targets[Label('gen')] = {
+      'type': 'action_foreach',
+      'script': '//build/generate.py',
+      'args': ['--in', '{{source}}', '--out', '{{source_name_part}}.cc'],
+      'sources': ['//%s/gen/input%d.fidl' % (directory, i)
+                  for i in range(fanout)],
+      'outputs': ['//out/gen/%s/input%d.cc' % (directory, i)
+                  for i in range(fanout)],
+    }
+
+    previous = Label('gen')
+    for level in range(depth):
+      properties = dict(common)
+      properties.update({
+        'type': 'source_set',
+        'sources': ['//%s/set%d_%d.cc' % (directory, level, i)
+                    for i in range(rng.randint(1, 4))],
+        'deps': [previous],
+      })
+      previous = Label('set%d' % level)
+      targets[previous] = properties
+
+    library = Label('lib')
+    properties = dict(common)
+    properties.update({
+      'type': 'static_library',
+      'sources': ['//%s/lib.cc' % directory],
+      'deps': [previous],
+    })
+    targets[library] = properties
+
+    properties = dict(common)
+    properties.update({
+      'type': 'executable',
+      'sources': ['//%s/main.cc' % directory],
+      'deps': [library] + rng.sample(libraries, min(links, len(libraries))),
+      'libs': ['zircon'],
+      'ldflags': ['-Wl,--gc-sections'],
+    })
+    targets[Label('bin')] = properties
+    libraries.append(library)
+
+  return {
+    'build_settings': {
+      'root_path': root_path,
+      'build_dir': '//out/benchmark/',
+      'default_toolchain': '//build/toolchain:x64',
+    },
+    'targets': targets,
+  }
+
+
+def GetPeakMemory():
+  """Returns the peak resident set size of this process so far, in MiB."""
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Linux reports kilobytes, macOS reports bytes.
+  if sys.platform == 'darwin':
+    return peak / (1024.0 * 1024.0)
+  return peak / 1024.0
+
+
+class Phase(object):
+  """Prints the duration, throughput and peak memory of a benchmark phase."""
+  def __init__(self, name, target_count):
+    self.name = name
+    self.target_count = target_count
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, *args):
+    elapsed = time.time() - self.start
+    print('%-8s %8.3fs %10.0f targets/s %8.1f MiB peak' %
+          (self.name, elapsed, self.target_count / max(elapsed, 1e-9),
+           GetPeakMemory()))
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Benchmarks gn_to_cmake.py on a synthetic project.json')
+  parser.add_argument('--components', type=int, default=1000,
+                      help='Number of components in the graph')
+  parser.add_argument('--depth', type=int, default=6,
+                      help='Length of the source_set chain of each component')
+  parser.add_argument('--fanout', type=int, default=8,
+                      help='Number of sources of each action_foreach')
+  parser.add_argument('--links', type=int, default=4,
+                      help='Number of other components each executable links')
+  parser.add_argument('--seed', type=int, default=0,
+                      help='Seed of the graph generator')
+  parser.add_argument('--jobs', '-j', type=int, default=1,
+                      help='Number of processes rendering targets')
+  parser.add_argument('--streaming', action='store_true',
+                      help='Load project.json with the streaming parser')
+  parser.add_argument('--incremental', action='store_true',
+                      help='Write one fragment per gn directory')
+  parser.add_argument('--keep',
+                      help='Directory in which to keep the generated files')
+  args = parser.parse_args()
+
+  root_path = tempfile.mkdtemp(prefix='gn_to_cmake_benchmark')
+  try:
+    project_json = GenerateProject(root_path, args.components, args.depth,
+                                   args.fanout, args.links, args.seed)
+    target_count = len(project_json['targets'])
+    build_path = os.path.join(root_path, 'out', 'benchmark')
+    os.makedirs(build_path)
+    json_path = os.path.join(build_path, 'project.json')
+    with open(json_path, 'w') as json_file:
+      json.dump(project_json, json_file, indent=2, sort_keys=True)
+    del project_json
+    print('%d targets, project.json is %.1f MiB' %
+          (target_count, os.path.getsize(json_path) / (1024.0 * 1024.0)))
+
+    with Phase('load', target_count):
+      with open(json_path, 'r') as json_file:
+        if args.streaming:
+          project_json = gn_to_cmake.LoadProjectStreaming(json_file)
+        else:
+          project_json = json.loads(json_file.read())
+    with Phase('project', target_count):
+      project = gn_to_cmake.Project(project_json)
+    with Phase('closure', target_count):
+      project.GetObjectIndex()
+    with Phase('write', target_count):
+      gn_to_cmake.WriteProject(project, incremental=args.incremental,
+                               jobs=args.jobs)
+
+    if args.keep:
+      shutil.rmtree(args.keep, ignore_errors=True)
+      shutil.copytree(build_path, args.keep)
+  finally:
+    shutil.rmtree(root_path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 The Fuchsia Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Records memgraph snapshots over time and reports what grew.
+
+Each snapshot is reduced with treemap.build_tree to the area of every node
+of the tree, keyed by the node's stable path (see treemap.stable_key), and
+appended to a store directory holding two files:
+
+  paths: the interned node paths, one per line; a path's ID is its line
+         number. Each line is a JSON list of (parent path ID, node type,
+         node name), with a parent ID of -1 for the root.
+  samples: the samples, back to back. Each one is a little-endian header of
+           (timestamp as a double, number of nodes as a uint32) followed by
+           the column of path IDs (uint32) and then the column of areas
+           (uint64).
+
+Example, sampling a device every 10 minutes:
+
+  sampler.py record --store logs --interval 600 \\
+      --command 'fx shell memgraph -j'
+
+and then listing what grew the most over the last hour:
+
+  sampler.py query --store logs --last 3600
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import os
+import struct
+import subprocess
+import sys
+import time
+
+import treemap
+
+HEADER = struct.Struct('<dI')
+
+
+class PathTable(object):
+    """The interned node paths of a store.
+
+    Paths are stored as a trie: each path refers to the ID of its parent, so
+    the long prefixes shared by most paths are only written once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.paths = []
+        self.ids = {}
+        if os.path.exists(path):
+            with open(path, 'r') as paths_file:
+                for line in paths_file:
+                    parent_id, node_type, name = json.loads(line)
+                    parent = self.paths[parent_id] if parent_id >= 0 else ()
+                    node_path = parent + ((node_type, name),)
+                    self.ids[node_path] = len(self.paths)
+                    self.paths.append(node_path)
+
+    def intern(self, node_paths):
+        """Returns the IDs of the given paths, appending any new ones.
+
+        The parent of each path must come before it in node_paths, or already
+        be in the table.
+        """
+        ids = []
+        new_entries = []
+        for node_path in node_paths:
+            path_id = self.ids.get(node_path)
+            if path_id is None:
+                path_id = len(self.paths)
+                self.ids[node_path] = path_id
+                self.paths.append(node_path)
+                parent_id = -1
+                if len(node_path) > 1:
+                    parent_id = self.ids[node_path[:-1]]
+                new_entries.append([parent_id] + list(node_path[-1]))
+            ids.append(path_id)
+        if new_entries:
+            with open(self.path, 'a') as paths_file:
+                for entry in new_entries:
+                    paths_file.write(json.dumps(entry) + '\n')
+        return ids
+
+
+class Store(object):
+    """An append-only store of memgraph samples."""
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.paths = PathTable(os.path.join(directory, 'paths'))
+        self.samples_path = os.path.join(directory, 'samples')
+
+    def append(self, timestamp, root_node):
+        """Adds the areas of a tree to the store."""
+        areas = treemap.flatten_tree(root_node)
+        node_paths = sorted(areas)
+        ids = self.paths.intern(node_paths)
+        count = len(ids)
+        with open(self.samples_path, 'ab') as samples:
+            samples.write(HEADER.pack(timestamp, count))
+            samples.write(struct.pack('<%dI' % count, *ids))
+            samples.write(struct.pack('<%dQ' % count,
+                                      *[max(0, areas[p]) for p in node_paths]))
+
+    def read(self, since=None, until=None):
+        """Yields the (timestamp, {path ID: area}) samples of a time window.
+
+        Samples outside of the window are skipped without being decoded.
+        """
+        if not os.path.exists(self.samples_path):
+            return
+        with open(self.samples_path, 'rb') as samples:
+            while True:
+                header = samples.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return
+                timestamp, count = HEADER.unpack(header)
+                if ((since is not None and timestamp < since) or
+                        (until is not None and timestamp > until)):
+                    samples.seek(count * 12, os.SEEK_CUR)
+                    continue
+                ids = struct.unpack('<%dI' % count, samples.read(count * 4))
+                areas = struct.unpack('<%dQ' % count, samples.read(count * 8))
+                yield timestamp, dict(zip(ids, areas))
+
+
+def take_snapshot(command):
+    """Runs a command printing a memgraph snapshot and returns its tree."""
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
+    try:
+        return treemap.build_tree(treemap.read_records(process.stdout))
+    finally:
+        process.stdout.close()
+        if process.wait():
+            raise Exception('Error: "{}" failed'.format(command))
+
+
+def record(args):
+    store = Store(args.store)
+    for path in args.files:
+        with open(path, 'r') as snapshot:
+            root_node = treemap.build_tree(treemap.read_records(snapshot))
+        store.append(os.path.getmtime(path), root_node)
+    if not args.command:
+        return 0
+    taken = 0
+    while True:
+        started = time.time()
+        store.append(started, take_snapshot(args.command))
+        taken += 1
+        if args.count and taken >= args.count:
+            return 0
+        time.sleep(max(0, args.interval - (time.time() - started)))
+
+
+def growth_by_key(paths, first, last, key):
+    """Sums the growth between two samples, grouped by key(path).
+
+    Paths for which key returns None are ignored.
+    """
+    growth = collections.defaultdict(int)
+    for path_id in set(first) | set(last):
+        group = key(paths[path_id])
+        if group is not None:
+            growth[group] += last.get(path_id, 0) - first.get(path_id, 0)
+    return growth
+
+
+def process_key(path):
+    """Groups process nodes by their path of job and process names."""
+    if path[-1][0] != 'p':
+        return None
+    return ' / '.join(name for node_type, name in path
+                      if node_type in ('j', 'p'))
+
+
+def vmo_name_key(path):
+    """Groups VMO nodes by name, across processes."""
+    if path[-1][0] != 'vmo':
+        return None
+    return path[-1][1]
+
+
+def print_top(title, growth, top):
+    print(title)
+    ranked = sorted(growth.items(), key=lambda item: (-item[1], item[0]))
+    for name, delta in ranked[:top]:
+        if delta <= 0:
+            break
+        print('  +{:>8} {}'.format(treemap.format_size(delta), name))
+
+
+def query(args):
+    store = Store(args.store)
+    since = args.since
+    if args.last is not None:
+        last_timestamp = None
+        for timestamp, _ in store.read(since=since, until=args.until):
+            if last_timestamp is None or timestamp > last_timestamp:
+                last_timestamp = timestamp
+        if last_timestamp is None:
+            print('No samples in the requested window')
+            return 1
+        since = max(since or 0, last_timestamp - args.last)
+
+    first = last = None
+    # Samples may have been appended out of order, e.g. from old files.
+    for sample in store.read(since=since, until=args.until):
+        if first is None or sample[0] < first[0]:
+            first = sample
+        if last is None or sample[0] >= last[0]:
+            last = sample
+    if first is None:
+        print('No samples in the requested window')
+        return 1
+
+    def format_time(timestamp):
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(timestamp))
+    print('Growth from {} to {}'.format(format_time(first[0]),
+                                        format_time(last[0])))
+    paths = store.paths.paths
+    print_top('Processes:',
+              growth_by_key(paths, first[1], last[1], process_key), args.top)
+    print_top('VMO names:',
+              growth_by_key(paths, first[1], last[1], vmo_name_key), args.top)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Records memgraph snapshots and reports growth')
+    subparsers = parser.add_subparsers()
+
+    record_parser = subparsers.add_parser(
+            'record', help='Adds snapshots to a store')
+    record_parser.add_argument('--store', required=True,
+                               help='Directory holding the samples')
+    record_parser.add_argument('--command',
+                               help='Command printing a memgraph snapshot, '
+                                    'run periodically')
+    record_parser.add_argument('--interval', type=float, default=600,
+                               help='Seconds between two runs of --command')
+    record_parser.add_argument('--count', type=int, default=0,
+                               help='Number of runs of --command; 0 means '
+                                    'forever')
+    record_parser.add_argument('files', nargs='*',
+                               help='memgraph snapshots to add, timestamped '
+                                    'with their modification time')
+    record_parser.set_defaults(func=record)
+
+    query_parser = subparsers.add_parser(
+            'query', help='Prints what grew the most over a time window')
+    query_parser.add_argument('--store', required=True,
+                              help='Directory holding the samples')
+    query_parser.add_argument('--since', type=float,
+                              help='Start of the window, in seconds since '
+                                   'the epoch')
+    query_parser.add_argument('--until', type=float,
+                              help='End of the window, in seconds since the '
+                                   'epoch')
+    query_parser.add_argument('--last', type=float,
+                              help='Only look at this many seconds before '
+                                   'the last sample in the window')
+    query_parser.add_argument('--top', type=int, default=10,
+                              help='Number of entries to print per category')
+    query_parser.set_defaults(func=query)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,13 +14,26 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import argparse
 import cgi
 import collections
+import csv
+import fnmatch
+import glob
+import hashlib
+import heapq
 import json
+import multiprocessing
 import sys
 import os.path
+import re
 import textwrap
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 FUCHSIA_DIR = os.path.abspath(os.path.join(__file__, os.pardir, os.pardir, os.pardir))
 
 # Magic value for nodes with empty names.
@@ -30,6 +43,8 @@ UNNAMED_NAME = '<unnamed>'
 class Node(object):
     """A generic node in the kernel/job/process/memory tree."""
 
+    __slots__ = ('type', 'koid', 'name', 'area', 'children')
+
     def __init__(self):
         self.type = ''
         self.koid = 0
@@ -52,25 +67,6 @@ class Node(object):
         return tag + name
 
 
-# Mapping of unique ID strings to Node objects.
-ids_to_nodes = {}
-
-
-def lookup(node_id):
-    """Returns or creates the Node associated with an ID string.
-
-    Args:
-        node_id: ID string to look up
-    Returns:
-        A Node object
-    """
-    node = ids_to_nodes.get(node_id)
-    if node is None:
-        node = Node()
-        ids_to_nodes[node_id] = node
-    return node
-
-
 def sum_area(node):
     """Recursively calculates the Node.area values of a subtree.
 
@@ -88,6 +84,17 @@ def sum_area(node):
     return node.area
 
 
+def clone_tree(node):
+    """Returns a deep copy of a subtree."""
+    clone = Node()
+    clone.type = node.type
+    clone.koid = node.koid
+    clone.name = node.name
+    clone.area = node.area
+    clone.children = [clone_tree(c) for c in node.children]
+    return clone
+
+
 def format_size(nbytes):
     """Formats a size as a human-readable string like "123.4k".
 
@@ -133,116 +140,142 @@ def format_size(nbytes):
 VIA_HANDLE = 1
 VIA_MAPPING = 2
 
+# The maximum number of distinct sets of VMOs TreeBuilder remembers.
+PROCESS_CACHE_SIZE = 1 << 16
 
-def populate_process(process_node, process_record, hide_aggregated=True):
-    """Adds the process's child nodes.
 
-    Args:
-        process_node: A process's Node
-        process_record: The same process's input record
-        hide_aggregated: If true, do not create Nodes for individual VMOs
-                that have been aggregated by name into a single Node
+class ColumnarProcessTable(object):
+    """Columnar alternative to TreeBuilder.populate_process.
+
+    The VMOs and VMO references of every process are appended to flat columns
+    as records are read. Once all records have been seen, populate() computes
+    each process's share of its VMOs and groups them by name with NumPy array
+    operations, creating Nodes only for what ends up in the tree.
     """
-    # If there aren't any VMOs, use the sizes in the record.
-    if not process_record.get('vmo_refs', []):
-        # Get the breakdown.
-        priv = process_record.get('private_bytes', 0)
-        pss = process_record.get('pss_bytes', 0)
-        shared = max(0, pss - priv)  # Kernel calls this "scaled shared"
-
-        pid = process_record['id']
-        if priv:
-            node = lookup(pid + '/priv')
-            node.name = 'Private'
-            node.area = priv
-            process_node.children.append(node)
-        if shared:
-            node = lookup(pid + '/shared')
-            node.name = 'Proportional shared'
-            node.area = shared
-            process_node.children.append(node)
-        # The process's area will be set to the sum of the children.
-        return
-    # Otherwise, this entry has VMOs.
-
-    # Build the set of reference types from this process to its VMOs.
-    koid_to_ref_types = collections.defaultdict(set)
-    for vmo_ref in process_record.get('vmo_refs', []):
-        ref_types = koid_to_ref_types[vmo_ref['vmo_koid']]
-        if 'HANDLE' in vmo_ref['via']:
-            ref_types.update([VIA_HANDLE])
-        if 'MAPPING' in vmo_ref['via']:
-            ref_types.update([VIA_MAPPING])
-
-    # De-dup the set of VMOs known to the process, and group them by name. Each
-    # of these entries are equivalent, though some values may be different (like
-    # committed_bytes) because they were snapshotted at different times.
-    name_to_vmo = collections.defaultdict(list)
-    koid_to_vmo = dict()
-    id_prefix = '{}/vmo'.format(process_record['id'])
-    for vmo in process_record.get('vmos', []):
-        # Although multiple processes may point to the same VMO, we're building
-        # a tree and thus need to create unique IDs for VMOs under this process.
-        vmo_koid = vmo['koid']
-        vmo_id = '{}/{}'.format(id_prefix, vmo_koid)
-        vmo_node = lookup(vmo_id)
-        if vmo_node.name:
-            # This is a duplicate of a VMO we've already seen.
-            continue
 
-        vmo_node.type = 'vmo'
-        vmo_node.koid = vmo_koid
-        vmo_node.name = vmo['name'] if vmo['name'] else UNNAMED_NAME
-        name_to_vmo[vmo_node.name].append(vmo_node)
-        koid_to_vmo[vmo_koid] = vmo_node
-
-        # Figure out a size for the VMO.
-        ref_types = koid_to_ref_types[vmo_koid]
-        if VIA_MAPPING in ref_types:
-            # The VMO is already accounted for in the process's pss_bytes value.
-            # TODO(dbort): To make the VMO areas exactly line up with pss_bytes,
-            # we'd need sub-VMO mapping information like what 'vmaps' provides:
-            # this process may only map a subset of the VMO's committed pages,
-            # but we're counting all of them. This isn't necessarily wrong,
-            # just different.
-            vmo_node.area = int(
-                    float(vmo['committed_bytes']) / vmo['share_count'])
-            # NB: This counts as private memory if share_count is 1.
-        else:
-            # The process only has a handle to this VMO but does not map it: the
-            # process's pss_bytes value does not account for this VMO.
-            assert ref_types == set([VIA_HANDLE])
-            # Treat our handle reference as an increment to the VMO's
-            # share_count. This may over-estimate this process's share, because
-            # other processes could also have handle-only references that we
-            # don't know about.
-            vmo_node.area = int(float(vmo['committed_bytes']) /
-                                (float(vmo['share_count']) + 1))
-
-    # Create the aggregated VMO nodes.
-    children = []
-    for name, vmos in name_to_vmo.iteritems():
-        if len(vmos) == 1 or name == UNNAMED_NAME:
-            # Only one VMO with this name, or multiple VMOs with an empty name.
-            # Add them as direct children.
-            children.extend(vmos)
-        else:
+    def __init__(self):
+        self.process_nodes = []
+        self.names = []
+        self.name_ids = {}
+        # One row per VMO entry of a process, duplicates included.
+        self.vmo_process = []
+        self.vmo_koid = []
+        self.vmo_name = []
+        self.vmo_committed = []
+        self.vmo_share_count = []
+        # One row per VMO reference of a process.
+        self.ref_process = []
+        self.ref_koid = []
+        self.ref_mapped = []
+
+    def _intern(self, name):
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = len(self.names)
+            self.name_ids[name] = name_id
+            self.names.append(name)
+        return name_id
+
+    def add(self, process_node, process_record):
+        """Records a process's VMOs, to be turned into Nodes by populate()."""
+        index = len(self.process_nodes)
+        self.process_nodes.append(process_node)
+        for vmo_ref in process_record['vmo_refs']:
+            self.ref_process.append(index)
+            self.ref_koid.append(vmo_ref['vmo_koid'])
+            self.ref_mapped.append('MAPPING' in vmo_ref['via'])
+        for vmo in process_record.get('vmos', []):
+            self.vmo_process.append(index)
+            self.vmo_koid.append(vmo['koid'])
+            self.vmo_name.append(
+                    self._intern(vmo['name'] if vmo['name'] else UNNAMED_NAME))
+            self.vmo_committed.append(vmo['committed_bytes'])
+            self.vmo_share_count.append(vmo['share_count'])
+
+    def populate(self, hide_aggregated=True):
+        """Adds the VMO Nodes of every recorded process.
+
+        Produces the same children as TreeBuilder.populate_process would.
+
+        Args:
+            hide_aggregated: If true, do not create Nodes for individual VMOs
+                    that have been aggregated by name into a single Node
+        """
+        if not self.vmo_process:
+            return
+        int64 = numpy.int64
+        vmo_process = numpy.array(self.vmo_process, dtype=int64)
+        vmo_koid = numpy.array(self.vmo_koid, dtype=int64)
+        ref_process = numpy.array(self.ref_process, dtype=int64)
+        ref_koid = numpy.array(self.ref_koid, dtype=int64)
+
+        # Give each (process, koid) pair a single integer key.
+        koids, koid_ranks = numpy.unique(
+                numpy.concatenate([vmo_koid, ref_koid]), return_inverse=True)
+        vmo_key = vmo_process * len(koids) + koid_ranks[:len(vmo_koid)]
+        ref_key = ref_process * len(koids) + koid_ranks[len(vmo_koid):]
+
+        # De-dup the VMOs of each process, keeping the first entry.
+        _, first = numpy.unique(vmo_key, return_index=True)
+        process = vmo_process[first]
+        koid = vmo_koid[first]
+        name = numpy.array(self.vmo_name, dtype=int64)[first]
+        committed = numpy.array(self.vmo_committed, dtype=numpy.float64)[first]
+        share_count = numpy.array(self.vmo_share_count,
+                                  dtype=numpy.float64)[first]
+
+        # Mapped VMOs are already accounted for in the process's pss_bytes.
+        # Handle-only references count as an extra share of the VMO. See
+        # TreeBuilder.populate_process for the details.
+        mapped_keys = numpy.unique(
+                ref_key[numpy.array(self.ref_mapped, dtype=bool)])
+        mapped = numpy.in1d(vmo_key[first], mapped_keys)
+        area = (committed /
+                numpy.where(mapped, share_count, share_count + 1)).astype(int64)
+
+        # Group the VMOs of each process by name.
+        group_key = process * len(self.names) + name
+        order = numpy.argsort(group_key, kind='mergesort')
+        _, group_start, group_size = numpy.unique(
+                group_key[order], return_index=True, return_counts=True)
+        group_area = numpy.add.reduceat(area[order], group_start)
+
+        # Create the Nodes. Plain lists are much faster to index from Python
+        # than NumPy arrays.
+        order = order.tolist()
+        process = process.tolist()
+        name = name.tolist()
+        koid = koid.tolist()
+        area = area.tolist()
+        unnamed_id = self.name_ids.get(UNNAMED_NAME)
+        for start, size, total in zip(group_start.tolist(),
+                                      group_size.tolist(),
+                                      group_area.tolist()):
+            rows = order[start:start + size]
+            process_node = self.process_nodes[process[rows[0]]]
+            name_id = name[rows[0]]
+            vmo_name = self.names[name_id]
+            if size == 1 or name_id == unnamed_id or not hide_aggregated:
+                vmo_nodes = []
+                for row in rows:
+                    vmo_node = Node()
+                    vmo_node.type = 'vmo'
+                    vmo_node.koid = koid[row]
+                    vmo_node.name = vmo_name
+                    vmo_node.area = area[row]
+                    vmo_nodes.append(vmo_node)
+                if size == 1 or name_id == unnamed_id:
+                    process_node.children.extend(vmo_nodes)
+                    continue
             # Create a parent VMO for all of these VMOs with the same name.
-            parent_id = '{}/{}'.format(id_prefix, name)
-            pnode = lookup(parent_id)
-            pnode.name = '{}[{}]'.format(name, len(vmos))
+            pnode = Node()
+            pnode.name = '{}[{}]'.format(vmo_name, size)
             pnode.type = 'vmo'
             if hide_aggregated:
-                pnode.area = sum(map(sum_area, vmos))
-                # And then drop the vmo nodes on the ground (by not adding
-                # them as children).
+                pnode.area = total
             else:
-                # The area will be calculated from the children.
-                pnode.children.extend(vmos)
-            children.append(pnode)
-    # TODO(dbort): Call out VMOs/aggregates that are only reachable via handle?
-
-    process_node.children.extend(children)
+                pnode.children.extend(vmo_nodes)
+            process_node.children.append(pnode)
 
 
 def build_webtreemap(node):
@@ -272,6 +305,46 @@ def build_webtreemap(node):
     }
 
 
+def html_table_header():
+    """Returns the HTML lines opening the table of dump_html_table."""
+    return [
+            '<style>',
+            'table#tree {',
+            '    border-collapse: collapse;',
+            '    border-spacing: 0;',
+            '}',
+            'table#tree tr:nth-child(even) {',
+            '    background-color: #eee;',
+            '}',
+            'table#tree tr:nth-child(odd) {',
+            '    background-color: #fff;',
+            '}',
+            'table#tree tr:hover {',
+            '    background-color: #ff8;',
+            '}',
+            'table#tree td {',
+            '    text-align: right;',
+            '    padding-left: 1em;',
+            '    padding-right: 1em;',
+            '    font-family:Consolas,Monaco,Lucida Console,',
+            '        Liberation Mono,DejaVu Sans Mono,',
+            '        Bitstream Vera Sans Mono,Courier New,monospace;',
+            '}',
+            'table#tree td.name {',
+            '    text-align: left;',
+            '}',
+            '</style>',
+            '<table id="tree">',
+            '<tr>',
+            '<th>Name</th>',
+            '<th>Size<br/>(bytes/1024^n)</th>',
+            '<th>Size (bytes)</th>',
+            '<th>Fraction of parent</th>',
+            '<th>Fraction of total</th>',
+            '</tr>',
+    ]
+
+
 def dump_html_table(node, depth=0, parent_area=None, total_area=None):
     """Returns an HTML representation of the tree.
 
@@ -289,42 +362,7 @@ def dump_html_table(node, depth=0, parent_area=None, total_area=None):
 
     if not depth:
         # We're the root node. Dump the headers.
-        lines.extend([
-                '<style>',
-                'table#tree {',
-                '    border-collapse: collapse;',
-                '    border-spacing: 0;',
-                '}',
-                'table#tree tr:nth-child(even) {',
-                '    background-color: #eee;',
-                '}',
-                'table#tree tr:nth-child(odd) {',
-                '    background-color: #fff;',
-                '}',
-                'table#tree tr:hover {',
-                '    background-color: #ff8;',
-                '}',
-                'table#tree td {',
-                '    text-align: right;',
-                '    padding-left: 1em;',
-                '    padding-right: 1em;',
-                '    font-family:Consolas,Monaco,Lucida Console,',
-                '        Liberation Mono,DejaVu Sans Mono,',
-                '        Bitstream Vera Sans Mono,Courier New,monospace;',
-                '}',
-                'table#tree td.name {',
-                '    text-align: left;',
-                '}',
-                '</style>',
-                '<table id="tree">',
-                '<tr>',
-                '<th>Name</th>',
-                '<th>Size<br/>(bytes/1024^n)</th>',
-                '<th>Size (bytes)</th>',
-                '<th>Fraction of parent</th>',
-                '<th>Fraction of total</th>',
-                '</tr>',
-        ])
+        lines.extend(html_table_header())
 
     lines.extend([
             '<tr>',
@@ -369,28 +407,71 @@ def dump_html_table(node, depth=0, parent_area=None, total_area=None):
     return lines
 
 
-def build_tree(dataset):
-    """Builds a Node tree from a set of memgraph records.
+class TreeBuilder(object):
+    """Builds a Node tree from memgraph records, one record at a time.
 
-    See
-    https://fuchsia.googlesource.com/zircon/+/master/docs/memory.md#Visualize-memory-usage
-    for an example of generating memgraph JSON data.
-
-    Args:
-        dataset: A sequence of memgraph records, typically parsed from JSON
-    Returns:
-        The root of the new Node tree
+    All of the state of a build lives in the builder, so several snapshots
+    can be processed in the same process, one after the other or at the
+    same time.
     """
-    ids_to_nodes.clear()  # Clear out the global registry.
-    root_node = None
-    root_job = None
 
-    for record in dataset:
+    def __init__(self, backend='python', hide_aggregated=True):
+        """
+        Args:
+            backend: 'python' to build the VMO nodes of each process as its
+                    record is read, or 'numpy' to compute them all at once
+                    with a ColumnarProcessTable
+            hide_aggregated: If true, do not create Nodes for individual VMOs
+                    that have been aggregated by name into a single Node
+        """
+        self.hide_aggregated = hide_aggregated
+        self.root_node = None
+        self.root_job = None
+        # Job and process Nodes, keyed by integer koid.
+        self._registries = {'j': {}, 'p': {}}
+        # Nodes whose IDs don't carry a koid, like the kernel entries.
+        self._other_nodes = {}
+        # The (private, shared, PSS) bytes of each process record, keyed by
+        # integer koid.
+        self.process_stats = {}
+        # The process_summary of the processes with VMOs seen so far.
+        self._process_summaries = set()
+        # A process Node of each set of VMOs, keyed by process_key.
+        self._process_cache = {}
+        self._table = None
+        if backend == 'numpy':
+            if numpy is None:
+                raise ImportError('The numpy backend requires NumPy')
+            self._table = ColumnarProcessTable()
+
+    def lookup(self, node_id):
+        """Returns or creates the Node associated with an ID string.
+
+        Args:
+            node_id: ID string to look up, like 'j/1234' or 'kernel/vmo'
+        Returns:
+            A Node object
+        """
+        prefix, _, koid = node_id.partition('/')
+        registry = self._registries.get(prefix)
+        if registry is not None and koid.isdigit():
+            key = int(koid)
+        else:
+            registry = self._other_nodes
+            key = node_id
+        node = registry.get(key)
+        if node is None:
+            node = Node()
+            registry[key] = node
+        return node
+
+    def add_record(self, record):
+        """Adds a single memgraph record to the tree."""
         record_type = record['type']
         # Only read certain types.
         if record_type not in ('kernel', 'j', 'p'):
-            continue
-        node = lookup(record['id'])
+            return
+        node = self.lookup(record['id'])
         node.type = record_type
         node.koid = record.get('koid', 0)
         node.name = record['name']
@@ -398,57 +479,853 @@ def build_tree(dataset):
             node.area = record.get('size_bytes', 0)
         elif record_type == 'j':
             if record['parent'].startswith('kernel/'):
-                assert not root_job, 'Found multiple root jobs'
-                root_job = node
+                assert not self.root_job, 'Found multiple root jobs'
+                self.root_job = node
         elif record_type == 'p':
+            self.process_stats[node.koid] = (
+                    record.get('private_bytes', 0),
+                    record.get('shared_bytes', 0),
+                    record.get('pss_bytes', 0))
             # Add the process's children, which will determine its area.
-            populate_process(node, record)
+            if self._table is None or not record.get('vmo_refs', []):
+                self.populate_process(node, record)
+            else:
+                self._table.add(node, record)
         if not record['parent']:
             # The root node has an empty parent.
-            assert not root_node, 'Found multiple root objects'
-            root_node = node
+            assert not self.root_node, 'Found multiple root objects'
+            self.root_node = node
         else:
-            parent_node = lookup(record['parent'])
+            parent_node = self.lookup(record['parent'])
             parent_node.children.append(node)
 
-    assert root_node, 'Did not find root object'
-    assert root_job, 'Did not find root job'
+    def populate_process(self, process_node, process_record):
+        """Adds the process's child nodes.
+
+        Args:
+            process_node: A process's Node
+            process_record: The same process's input record
+        """
+        # If there aren't any VMOs, use the sizes in the record.
+        if not process_record.get('vmo_refs', []):
+            # Get the breakdown.
+            priv = process_record.get('private_bytes', 0)
+            pss = process_record.get('pss_bytes', 0)
+            shared = max(0, pss - priv)  # Kernel calls this "scaled shared"
+
+            if priv:
+                node = Node()
+                node.name = 'Private'
+                node.area = priv
+                process_node.children.append(node)
+            if shared:
+                node = Node()
+                node.name = 'Proportional shared'
+                node.area = shared
+                process_node.children.append(node)
+            # The process's area will be set to the sum of the children.
+            return
+        # Otherwise, this entry has VMOs. Processes like the instances of a
+        # component often share the exact same VMOs, so only compute their
+        # Nodes once per set of VMOs, and give the following processes copies.
+        # Nodes are not modified until finish(), so the copies are identical
+        # to what build_vmo_nodes would return. To keep unique processes
+        # cheap, the full key is only computed for processes whose summary
+        # has already been seen.
+        summary = self.process_summary(process_record)
+        if summary not in self._process_summaries:
+            if len(self._process_summaries) < PROCESS_CACHE_SIZE:
+                self._process_summaries.add(summary)
+            process_node.children.extend(
+                    self.build_vmo_nodes(process_record))
+            return
+        key = self.process_key(process_record)
+        process = self._process_cache.get(key)
+        if process is None:
+            if len(self._process_cache) < PROCESS_CACHE_SIZE:
+                self._process_cache[key] = process_node
+            process_node.children.extend(
+                    self.build_vmo_nodes(process_record))
+        else:
+            process_node.children.extend(
+                    clone_tree(c) for c in process.children)
+
+    @staticmethod
+    def process_summary(process_record):
+        """Returns a cheap key shared by all the process records with the
+        same process_key, and by few others.
+        """
+        vmo_refs = process_record['vmo_refs']
+        vmos = process_record.get('vmos', [])
+        return (len(vmo_refs), vmo_refs[0]['vmo_koid'],
+                vmo_refs[-1]['vmo_koid'], len(vmos))
+
+    @staticmethod
+    def process_key(process_record):
+        """Returns a digest identifying the VMO Nodes of a process record.
+
+        The digest covers everything build_vmo_nodes reads: the koid and
+        reference types of each VMO reference, and the koid, name, committed
+        bytes and share count of each VMO, in order.
+        """
+        refs = [(vmo_ref['vmo_koid'], vmo_ref['via'])
+                for vmo_ref in process_record.get('vmo_refs', [])]
+        vmos = [(vmo['koid'], vmo['name'], vmo['committed_bytes'],
+                 vmo['share_count'])
+                for vmo in process_record.get('vmos', [])]
+        return hashlib.sha1(repr((refs, vmos)).encode('utf-8')).digest()
+
+    def build_vmo_nodes(self, process_record):
+        """Returns the VMO child Nodes of a process record with VMOs.
+
+        Args:
+            process_record: A process's input record
+        Returns:
+            A list of Nodes
+        """
+        # Build the set of reference types from this process to its VMOs.
+        koid_to_ref_types = collections.defaultdict(set)
+        for vmo_ref in process_record.get('vmo_refs', []):
+            ref_types = koid_to_ref_types[vmo_ref['vmo_koid']]
+            if 'HANDLE' in vmo_ref['via']:
+                ref_types.update([VIA_HANDLE])
+            if 'MAPPING' in vmo_ref['via']:
+                ref_types.update([VIA_MAPPING])
+
+        # De-dup the set of VMOs known to the process, and group them by name.
+        # Each of these entries are equivalent, though some values may be
+        # different (like committed_bytes) because they were snapshotted at
+        # different times.
+        name_to_vmo = collections.defaultdict(list)
+        koid_to_vmo = dict()
+        for vmo in process_record.get('vmos', []):
+            # Although multiple processes may point to the same VMO, we're
+            # building a tree and thus need to create unique Nodes for VMOs
+            # under this process.
+            vmo_koid = vmo['koid']
+            if vmo_koid in koid_to_vmo:
+                # This is a duplicate of a VMO we've already seen.
+                continue
+
+            vmo_node = Node()
+            vmo_node.type = 'vmo'
+            vmo_node.koid = vmo_koid
+            vmo_node.name = vmo['name'] if vmo['name'] else UNNAMED_NAME
+            name_to_vmo[vmo_node.name].append(vmo_node)
+            koid_to_vmo[vmo_koid] = vmo_node
+
+            # Figure out a size for the VMO.
+            ref_types = koid_to_ref_types[vmo_koid]
+            if VIA_MAPPING in ref_types:
+                # The VMO is already accounted for in the process's pss_bytes
+                # value.
+                # TODO(dbort): To make the VMO areas exactly line up with
+                # pss_bytes, we'd need sub-VMO mapping information like what
+                # 'vmaps' provides: this process may only map a subset of the
+                # VMO's committed pages, but we're counting all of them. This
+                # isn't necessarily wrong, just different.
+                vmo_node.area = int(
+                        float(vmo['committed_bytes']) / vmo['share_count'])
+                # NB: This counts as private memory if share_count is 1.
+            else:
+                # The process only has a handle to this VMO but does not map
+                # it: the process's pss_bytes value does not account for this
+                # VMO.
+                assert ref_types == set([VIA_HANDLE])
+                # Treat our handle reference as an increment to the VMO's
+                # share_count. This may over-estimate this process's share,
+                # because other processes could also have handle-only
+                # references that we don't know about.
+                vmo_node.area = int(float(vmo['committed_bytes']) /
+                                    (float(vmo['share_count']) + 1))
+
+        # Create the aggregated VMO nodes.
+        children = []
+        for name, vmos in name_to_vmo.iteritems():
+            if len(vmos) == 1 or name == UNNAMED_NAME:
+                # Only one VMO with this name, or multiple VMOs with an empty
+                # name. Add them as direct children.
+                children.extend(vmos)
+            else:
+                # Create a parent VMO for all of these VMOs with the same name.
+                pnode = Node()
+                pnode.name = '{}[{}]'.format(name, len(vmos))
+                pnode.type = 'vmo'
+                if self.hide_aggregated:
+                    pnode.area = sum(map(sum_area, vmos))
+                    # And then drop the vmo nodes on the ground (by not adding
+                    # them as children).
+                else:
+                    # The area will be calculated from the children.
+                    pnode.children.extend(vmos)
+                children.append(pnode)
+        # TODO(dbort): Call out VMOs/aggregates that are only reachable via
+        # handle?
+
+        return children
+
+    def finish(self):
+        """Completes the tree once all records have been added.
+
+        Returns:
+            The root of the new Node tree
+        """
+        root_node = self.root_node
+        root_job = self.root_job
+        assert root_node, 'Did not find root object'
+        assert root_job, 'Did not find root job'
+        # The cached Nodes are about to be summed; stop copying them.
+        self._process_summaries.clear()
+        self._process_cache.clear()
+
+        if self._table is not None:
+            self._table.populate(self.hide_aggregated)
+
+        # A better name for physmem.
+        self.lookup('kernel/physmem').name = 'All physical memory'
+
+        # Sum up the job tree. Don't touch kernel entries, which already have
+        # the correct sizes.
+        sum_area(root_job)
+
+        # The root job is usually named "root";
+        # make it more clear that it's a job.
+        root_job.name = 'root job'
+
+        # Give users a hint that processes live in the VMO entry.
+        kvmo_node = self.lookup('kernel/vmo')
+        kvmo_node.name = 'VMOs/processes'
+
+        # Create a fake entry to cover the portion of kernel/vmo that isn't
+        # covered by the job tree.
+        node = self.lookup('kernel/vmo/unknown')
+        node.name = 'unknown (kernel & unmapped)'
+        node.area = kvmo_node.area - root_job.area
+        kvmo_node.children.append(node)
+
+        return root_node
+
+
+def build_tree(dataset, backend='python'):
+    """Builds a Node tree from a set of memgraph records.
 
-    # A better name for physmem.
-    lookup('kernel/physmem').name = 'All physical memory'
+    See
+    https://fuchsia.googlesource.com/zircon/+/master/docs/memory.md#Visualize-memory-usage
+    for an example of generating memgraph JSON data.
+
+    Args:
+        dataset: A sequence of memgraph records, typically parsed from JSON
+        backend: The TreeBuilder backend to use, 'python' or 'numpy'
+    Returns:
+        The root of the new Node tree
+    """
+    builder = TreeBuilder(backend=backend)
+    for record in dataset:
+        builder.add_record(record)
+    return builder.finish()
 
-    # Sum up the job tree. Don't touch kernel entries, which already have
-    # the correct sizes.
-    sum_area(root_job)
 
-    # The root job is usually named "root";
-    # make it more clear that it's a job.
-    root_job.name = 'root job'
+def prune_tree(root_node, min_bytes=0, top_n_per_parent=0):
+    """Folds the small children of every Node into a single Node.
 
-    # Give users a hint that processes live in the VMO entry.
-    kvmo_node = lookup('kernel/vmo')
-    kvmo_node.name = 'VMOs/processes'
+    The children of a Node that are smaller than min_bytes, or that are not
+    among its top_n_per_parent largest, are replaced by one "other (N nodes)"
+    Node holding their total area. The subtrees of the folded children are
+    dropped, so that rendering only has to walk what is displayed.
 
-    # Create a fake entry to cover the portion of kernel/vmo that isn't
-    # covered by the job tree.
-    node = lookup('kernel/vmo/unknown')
-    node.name = 'unknown (kernel & unmapped)'
-    node.area = kvmo_node.area - root_job.area
-    kvmo_node.children.append(node)
+    Args:
+        root_node: The Node at the root of a tree with summed areas
+        min_bytes: The area below which children are folded; 0 keeps all
+        top_n_per_parent: The number of children to keep under each Node;
+                0 keeps all
+    """
+    stack = [root_node]
+    while stack:
+        node = stack.pop()
+        children = node.children
+        if not children:
+            continue
+        kept = [c for c in children if c.area >= min_bytes]
+        if top_n_per_parent and len(kept) > top_n_per_parent:
+            kept = heapq.nlargest(top_n_per_parent, kept,
+                                  key=lambda n: n.area)
+        if len(children) - len(kept) > 1:
+            kept_ids = set(map(id, kept))
+            folded = [c for c in children if id(c) not in kept_ids]
+            other = Node()
+            other.name = 'other ({} nodes)'.format(len(folded))
+            other.area = sum(c.area for c in folded)
+            node.children = kept + [other]
+        stack.extend(node.children)
+
+
+# Matches the "[n]" suffix of the names of aggregated VMO nodes.
+AGGREGATE_SUFFIX = re.compile(r'\[\d+\]$')
+
+
+def stable_key(node):
+    """Returns a key identifying a Node across snapshots.
+
+    Koids change from one boot to the next, so Nodes are identified by type
+    and name instead. The "[n]" suffix of VMO aggregates is dropped so that an
+    aggregate matches itself when its VMO count changes.
+    """
+    name = node.name
+    if node.type == 'vmo':
+        name = AGGREGATE_SUFFIX.sub('', name)
+    return (node.type, name)
 
-    return root_node
 
+def flatten_tree(root_node):
+    """Maps the stable path of every Node in a tree to its area.
 
-def print_html_document(root_node):
-    """Prints to stdout an HTML document that visualizes a Node tree.
+    Siblings sharing a stable key, like several instances of the same
+    process, are merged and their areas summed.
 
     Args:
         root_node: The Node at the root of the tree to walk
+    Returns:
+        A dict of tuples of stable keys, from the root down, to areas
     """
+    areas = collections.defaultdict(int)
+    stack = [((stable_key(root_node),), root_node)]
+    while stack:
+        path, node = stack.pop()
+        areas[path] += node.area
+        for child in node.children:
+            stack.append((path + (stable_key(child),), child))
+    return areas
+
+
+def diff_trees(old_root, new_root):
+    """Aligns two trees by stable path and compares their areas.
+
+    Args:
+        old_root: The root of the tree of the older snapshot
+        new_root: The root of the tree of the newer snapshot
+    Returns:
+        A tuple of:
+        - a list of (path, old area, new area) for every path whose area
+          changed, largest change first;
+        - the root of a Node tree of the growth of the leaves of both trees.
+    """
+    old_areas = flatten_tree(old_root)
+    new_areas = flatten_tree(new_root)
+    paths = set(old_areas) | set(new_areas)
+
+    changes = [(path, old_areas.get(path, 0), new_areas.get(path, 0))
+               for path in paths
+               if old_areas.get(path, 0) != new_areas.get(path, 0)]
+    changes.sort(key=lambda change: (-abs(change[2] - change[1]), change[0]))
+
+    # Build a tree of the leaves that grew.
+    nodes = {}
+    for path in sorted(paths, key=len):
+        node = Node()
+        node.type, node.name = path[-1]
+        nodes[path] = node
+        if len(path) > 1:
+            nodes[path[:-1]].children.append(node)
+    for path, node in nodes.items():
+        if not node.children:
+            node.area = max(0, new_areas.get(path, 0) - old_areas.get(path, 0))
+    growth_root = nodes[min(paths, key=len)]
+    sum_area(growth_root)
+    stack = [growth_root]
+    while stack:
+        node = stack.pop()
+        node.children = [c for c in node.children if c.area]
+        stack.extend(node.children)
+    return changes, growth_root
+
+
+def dump_html_diff_table(changes):
+    """Returns an HTML table of the changes computed by diff_trees.
+
+    Args:
+        changes: A list of (path, old area, new area)
+    Returns:
+        A sequence of HTML lines, joinable by whitespace
+    """
+    lines = [
+            '<style>',
+            'table#diff td {',
+            '    text-align: right;',
+            '    padding-left: 1em;',
+            '    padding-right: 1em;',
+            '}',
+            'table#diff td.name {',
+            '    text-align: left;',
+            '}',
+            'table#diff tr:nth-child(even) {',
+            '    background-color: #eee;',
+            '}',
+            '</style>',
+            '<table id="diff">',
+            '<tr>',
+            '<th>Name</th>',
+            '<th>Old size</th>',
+            '<th>New size</th>',
+            '<th>Change</th>',
+            '<th>Change (bytes)</th>',
+            '</tr>',
+    ]
+    for path, old_area, new_area in changes:
+        delta = new_area - old_area
+        lines.extend([
+                '<tr>',
+                '<td class="name">{}</td>'.format(' / '.join(
+                        cgi.escape(name) for _, name in path)),
+                '<td>{}</td>'.format(format_size(old_area)),
+                '<td>{}</td>'.format(format_size(new_area)),
+                '<td>{}{}</td>'.format('+' if delta > 0 else '-',
+                                       format_size(abs(delta))),
+                '<td>{:+d}</td>'.format(delta),
+                '</tr>',
+        ])
+    lines.append('</table>')
+    return lines
+
+
+def read_records(stream, chunk_size=1 << 16):
+    """Yields memgraph records from a stream as they are read.
+
+    Accepts both the JSON array printed by memgraph and newline-delimited
+    JSON, with one record per line. Only the record being decoded is held in
+    memory, so records can be fed to a TreeBuilder while a large dump is
+    still arriving.
+
+    Args:
+        stream: A file-like object to read from
+        chunk_size: How many characters to read at a time
+    Yields:
+        Each record, as parsed from JSON
+    """
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r'[ \t\n\r]*')
+    state = {'buffer': '', 'eof': False}
+
+    def fill():
+        """Reads more data, returning False at the end of the stream."""
+        if state['eof']:
+            return False
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            state['eof'] = True
+            return False
+        state['buffer'] += chunk
+        return True
+
+    def peek():
+        """Drops leading whitespace and returns the next character or ''."""
+        while True:
+            buf = state['buffer']
+            start = whitespace.match(buf).end()
+            if start:
+                state['buffer'] = buf[start:]
+            if state['buffer'] or not fill():
+                return state['buffer'][:1]
+
+    def decode():
+        """Decodes the next JSON value from the stream."""
+        while True:
+            buf = state['buffer']
+            try:
+                value, end = decoder.raw_decode(buf)
+                # Make sure a trailing number isn't cut short.
+                if end < len(buf) or state['eof']:
+                    state['buffer'] = buf[end:]
+                    return value
+            except ValueError:
+                if state['eof']:
+                    raise
+            fill()
+
+    in_array = peek() == '['
+    if in_array:
+        state['buffer'] = state['buffer'][1:]
+        if peek() == ']':
+            return
+    while peek():
+        yield decode()
+        if not in_array:
+            continue
+        separator = peek()
+        state['buffer'] = state['buffer'][1:]
+        if separator == ']':
+            return
+        if separator != ',':
+            raise ValueError(
+                    'Expected "," or "]" between records, got {!r}'.format(
+                            separator))
+    if in_array:
+        raise ValueError('Unterminated array of records')
+
+
+def iter_processes(root_node):
+    """Yields the (job path, process Node) pairs of a tree.
+
+    The job path is the list of the names of the jobs above the process,
+    from the root job down.
+    """
+    stack = [([], root_node)]
+    while stack:
+        jobs, node = stack.pop()
+        if node.type == 'p':
+            yield jobs, node
+            continue
+        if node.type == 'j':
+            jobs = jobs + [node.name]
+        for child in reversed(node.children):
+            stack.append((jobs, child))
+
+
+PROCESS_FIELDS = ('job', 'koid', 'name', 'pss_bytes', 'private_bytes',
+                  'shared_bytes', 'tree_bytes')
+
+
+def process_rows(root_node, process_stats):
+    """Yields a row per process, see PROCESS_FIELDS.
+
+    Args:
+        root_node: The root of a tree built by TreeBuilder
+        process_stats: The TreeBuilder.process_stats of the same tree
+    """
+    for jobs, node in iter_processes(root_node):
+        private, shared, pss = process_stats.get(node.koid, (0, 0, 0))
+        yield {
+                'job': '/'.join(jobs),
+                'koid': node.koid,
+                'name': node.name,
+                'pss_bytes': pss,
+                'private_bytes': private,
+                'shared_bytes': shared,
+                'tree_bytes': node.area,
+        }
+
+
+VMO_NAME_FIELDS = ('name', 'vmos', 'processes', 'bytes')
+
+
+def vmo_name_rows(root_node):
+    """Yields a row per VMO name, summed across processes, largest first.
+
+    See VMO_NAME_FIELDS. Aggregated VMO Nodes count for as many VMOs as
+    their "[n]" suffix says.
+    """
+    totals = collections.defaultdict(lambda: [0, 0, 0])
+    for _, process_node in iter_processes(root_node):
+        names = set()
+        for node in process_node.children:
+            if node.type != 'vmo':
+                continue
+            name = AGGREGATE_SUFFIX.sub('', node.name)
+            count = 1
+            if name != node.name:
+                count = int(node.name[len(name) + 1:-1])
+            total = totals[name]
+            total[0] += count
+            if name not in names:
+                names.add(name)
+                total[1] += 1
+            total[2] += node.area
+    for name, (vmos, processes, nbytes) in sorted(
+            totals.items(), key=lambda item: (-item[1][2], item[0])):
+        yield {
+                'name': name,
+                'vmos': vmos,
+                'processes': processes,
+                'bytes': nbytes,
+        }
+
+
+JOB_FIELDS = ('job', 'koid', 'processes', 'bytes')
+
+
+def job_rows(root_node):
+    """Yields a row per job with its total area, see JOB_FIELDS.
+
+    The processes column counts all the processes under the job, including
+    those of its child jobs.
+    """
+    # Walk the tree depth-first, emitting a job once its subtree is done.
+    stack = [([], root_node, False)]
+    process_counts = [0]
+    while stack:
+        jobs, node, done = stack.pop()
+        if node.type == 'p':
+            process_counts[-1] += 1
+            continue
+        if node.type != 'j':
+            for child in reversed(node.children):
+                stack.append((jobs, child, False))
+            continue
+        if done:
+            count = process_counts.pop()
+            process_counts[-1] += count
+            yield {
+                    'job': '/'.join(jobs),
+                    'koid': node.koid,
+                    'processes': count,
+                    'bytes': node.area,
+            }
+            continue
+        process_counts.append(0)
+        jobs = jobs + [node.name]
+        stack.append((jobs, node, True))
+        for child in reversed(node.children):
+            stack.append((jobs, child, False))
+
+
+def write_csv(rows, fields, stream):
+    """Writes rows to a stream as CSV, one at a time."""
+    writer = csv.DictWriter(stream, fieldnames=fields, lineterminator='\n')
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+
+
+def write_json_lines(rows, fields, stream):
+    """Writes rows to a stream as JSON Lines, one at a time."""
+    for row in rows:
+        stream.write(json.dumps(collections.OrderedDict(
+                (field, row[field]) for field in fields)))
+        stream.write('\n')
+
+
+def build_compact_tree(node):
+    """Returns a compact JSON-able representation of a Node tree.
+
+    Each node becomes a list of [type, name, koid, area] followed, for
+    nodes that have children, by the list of its children sorted from
+    largest to smallest. Labels and sizes are formatted by the browser, see
+    LAZY_SCRIPT.
+
+    Args:
+        node: The Node at the root of the tree to walk
+    Returns:
+        A nested list representing the tree
+    """
+    compact = [node.type, node.name, node.koid, node.area]
+    if node.children:
+        children = sorted(node.children, reverse=True, key=lambda n: n.area)
+        compact.append([build_compact_tree(c) for c in children])
+    return compact
+
+
+# Renders a tree produced by build_compact_tree. The treemap data is derived
+# from it in the browser, and table rows are only created when their parent
+# is expanded, a page of children at a time.
+LAZY_SCRIPT = '''
+function escapeHtml(s) {
+  return s.replace(/&/g, '&amp;').replace(/</g, '&lt;')
+      .replace(/>/g, '&gt;').replace(/"/g, '&quot;');
+}
+
+// See format_size in treemap.py.
+function formatSize(nbytes) {
+  var units = 'BkMGTPE';
+  var ui = 0;
+  var r = 0;
+  var whole = true;
+  while (nbytes >= 10000 || (nbytes != 0 && nbytes % 1024 == 0)) {
+    ui += 1;
+    if (nbytes % 1024) {
+      whole = false;
+    }
+    r = nbytes % 1024;
+    nbytes = Math.floor(nbytes / 1024);
+  }
+  if (whole) {
+    return nbytes + units[ui];
+  }
+  var roundUp = (r % 100) >= 50 ? 1 : 0;
+  r = Math.floor(r / 100) + roundUp;
+  if (r == 10) {
+    nbytes += 1;
+    r = 0;
+  }
+  return nbytes + '.' + r + units[ui];
+}
+
+// See Node.html_label in treemap.py.
+function htmlLabel(node) {
+  var type = node[0];
+  var name = node[1];
+  var tag = '';
+  if (type) {
+    tag = '<span class="treemap-node-type treemap-node-type-' +
+        escapeHtml(type[0]) + '">' + escapeHtml(type[0].toUpperCase()) +
+        '</span> ';
+  }
+  if (name == '' || name == '<unnamed>') {
+    return tag + '<i>UNNAMED</i> [koid ' + node[2] + ']';
+  }
+  return tag + escapeHtml(name);
+}
+
+// See build_webtreemap in treemap.py.
+function toWebtreemap(node) {
+  return {
+    'name': htmlLabel(node) + ' (' + formatSize(node[3]) + ')',
+    'data': {'$area': node[3]},
+    'children': (node[4] || []).map(toWebtreemap),
+  };
+}
+
+function fractionCell(fraction) {
+  var cell = document.createElement('td');
+  cell.innerHTML = (fraction * 100).toFixed(3) + '%&nbsp;' +
+      '<progress value="' + fraction + '"></progress>';
+  return cell;
+}
+
+// Creates the row of a node, along with the rows of its expanded children.
+function TreeRow(node, depth, parentArea, totalArea) {
+  this.node = node;
+  this.depth = depth;
+  this.childRows = [];
+  this.element = document.createElement('tr');
+
+  var nameCell = document.createElement('td');
+  nameCell.className = 'name';
+  var indent = '';
+  for (var i = 0; i < depth; i++) {
+    indent += '|&nbsp;&nbsp;';
+  }
+  var children = node[4] || [];
+  this.toggle = document.createElement('a');
+  this.toggle.className = 'toggle';
+  this.toggle.textContent = children.length ? '[+]' : '';
+  this.toggle.onclick = this.onToggle.bind(this);
+  nameCell.innerHTML = '<span style="color:#bbb">' + indent + '</span>';
+  nameCell.appendChild(this.toggle);
+  nameCell.insertAdjacentHTML('beforeend', ' ' + htmlLabel(node));
+  this.element.appendChild(nameCell);
+
+  var sizeCell = document.createElement('td');
+  sizeCell.textContent = formatSize(node[3]);
+  this.element.appendChild(sizeCell);
+  var bytesCell = document.createElement('td');
+  bytesCell.textContent = node[3];
+  this.element.appendChild(bytesCell);
+  if (depth) {
+    this.element.appendChild(fractionCell(parentArea ? node[3] / parentArea : 0));
+    this.element.appendChild(fractionCell(totalArea ? node[3] / totalArea : 0));
+  } else {
+    this.element.appendChild(document.createElement('td'));
+    this.element.appendChild(document.createElement('td'));
+  }
+  this.totalArea = depth ? totalArea : node[3];
+  this.moreRow = null;
+}
+
+// Returns the last row element under this one, to insert rows after it.
+TreeRow.prototype.lastElement = function() {
+  if (this.moreRow) {
+    return this.moreRow;
+  }
+  if (this.childRows.length) {
+    return this.childRows[this.childRows.length - 1].lastElement();
+  }
+  return this.element;
+};
+
+TreeRow.prototype.showChildren = function(count) {
+  var children = this.node[4] || [];
+  var after = this.lastElement();
+  if (this.moreRow) {
+    this.moreRow.parentNode.removeChild(this.moreRow);
+    this.moreRow = null;
+  }
+  var end = Math.min(children.length, this.childRows.length + count);
+  for (var i = this.childRows.length; i < end; i++) {
+    var row = new TreeRow(children[i], this.depth + 1, this.node[3],
+                          this.totalArea);
+    after.parentNode.insertBefore(row.element, after.nextSibling);
+    after = row.element;
+    this.childRows.push(row);
+  }
+  if (end < children.length) {
+    this.moreRow = document.createElement('tr');
+    var cell = document.createElement('td');
+    cell.className = 'name';
+    cell.colSpan = 5;
+    var link = document.createElement('a');
+    link.className = 'toggle';
+    link.textContent = (children.length - end) + ' more...';
+    link.onclick = this.showChildren.bind(this, kPageSize);
+    cell.appendChild(link);
+    this.moreRow.appendChild(cell);
+    after.parentNode.insertBefore(this.moreRow, after.nextSibling);
+  }
+  this.toggle.textContent = '[-]';
+};
+
+TreeRow.prototype.hideChildren = function() {
+  this.childRows.forEach(function(row) {
+    row.hideChildren();
+    row.element.parentNode.removeChild(row.element);
+  });
+  this.childRows = [];
+  if (this.moreRow) {
+    this.moreRow.parentNode.removeChild(this.moreRow);
+    this.moreRow = null;
+  }
+  if ((this.node[4] || []).length) {
+    this.toggle.textContent = '[+]';
+  }
+};
+
+TreeRow.prototype.onToggle = function() {
+  if (this.childRows.length) {
+    this.hideChildren();
+  } else {
+    this.showChildren(kPageSize);
+  }
+};
+'''
+
+
+def print_html_document(root_node, title='Memory usage', table_lines=None,
+                        page_size=None, output=None):
+    """Prints an HTML document that visualizes a Node tree.
+
+    Args:
+        root_node: The Node at the root of the tree to walk
+        title: The title of the document
+        table_lines: The HTML lines to show below the treemap; defaults to
+                the output of dump_html_table(root_node)
+        page_size: If set, embed the tree once as compact JSON and let the
+                browser create table rows as they are expanded, this many
+                children at a time. table_lines is ignored.
+        output: The file to print to; defaults to stdout
+    """
+    if page_size:
+        # Keep the JSON from closing the <script> element.
+        compact_json = json.dumps(build_compact_tree(root_node),
+                                  separators=(',', ':')).replace('</', '<\\/')
+        script = '%s\nvar kPageSize = %d;\nvar kCompactTree = %s;' % (
+                LAZY_SCRIPT, page_size, compact_json)
+        tree_json = 'toWebtreemap(kCompactTree)'
+        table_lines = html_table_header() + [
+                '</table>',
+                '<style>.toggle { cursor: pointer; color: #888; }</style>',
+                '<script>',
+                'var rootRow = new TreeRow(kCompactTree, 0);',
+                'document.getElementById("tree").appendChild(rootRow.element);',
+                'rootRow.showChildren(kPageSize);',
+                '</script>',
+        ]
+    else:
+        script = ''
+        tree_json = json.dumps(build_webtreemap(root_node))
+        if table_lines is None:
+            table_lines = dump_html_table(root_node)
     html = '''\
     <!DOCTYPE html>
-    <title>Memory usage</title>
-    <script>
+    <title>%(title)s</title>
+    <script>%(script)s
     var kTree = %(json)s
     </script>
     <link rel='stylesheet' href='%(css)s'>
@@ -476,7 +1353,7 @@ def print_html_document(root_node):
     .treemap-node-type-v { color: RGB(0, 158, 115); } /* Bluish green */
     </style>
 
-    <h1>Memory usage</h1>
+    <h1>%(title)s</h1>
 
     <p>Click on a box to zoom in.  Click on the outermost box to zoom out.</p>
 
@@ -502,18 +1379,399 @@ def print_html_document(root_node):
     <hr>
     %(table)s
     ''' % {
-            'json': json.dumps(build_webtreemap(root_node)),
-            'table': ' '.join(dump_html_table(root_node)),
+            'script': script,
+            'json': tree_json,
+            'title': cgi.escape(title),
+            'table': ' '.join(table_lines),
             'css': os.path.join(FUCHSIA_DIR, 'scripts', 'third_party', 'webtreemap', 'webtreemap.css'),
             'js': os.path.join(FUCHSIA_DIR, 'scripts', 'third_party', 'webtreemap', 'webtreemap.js'),
     }
-    print(textwrap.dedent(html))
+    print(textwrap.dedent(html), file=output)
+
+
+def write_report(root_node, process_stats, output, format='html',
+                 report='processes', page_size=0, min_bytes=0,
+                 top_n_per_parent=0):
+    """Writes the report of a tree built by a TreeBuilder.
+
+    Args:
+        root_node: The root of the tree
+        process_stats: The TreeBuilder.process_stats of the tree
+        output: The file to write to
+        format: 'html' for an HTML document, or 'csv' or 'jsonl' for one of
+                the flat reports
+        report: The flat report to write: 'processes', 'vmo-names' or 'jobs'
+        page_size: See print_html_document
+        min_bytes: See prune_tree
+        top_n_per_parent: See prune_tree; only applies to HTML documents
+    """
+    if format == 'html':
+        prune_tree(root_node, min_bytes, top_n_per_parent)
+        print_html_document(root_node, page_size=page_size, output=output)
+        return
+    if report == 'processes':
+        fields = PROCESS_FIELDS
+        rows = process_rows(root_node, process_stats)
+    elif report == 'vmo-names':
+        fields = VMO_NAME_FIELDS
+        rows = vmo_name_rows(root_node)
+    else:
+        fields = JOB_FIELDS
+        rows = job_rows(root_node)
+    if format == 'csv':
+        write_csv(rows, fields, output)
+    else:
+        write_json_lines(rows, fields, output)
+
+
+def find_snapshots(patterns):
+    """Returns the snapshot files matching a list of directories and globs.
+
+    Directories stand for all the .json files they contain.
+    """
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.json')
+        paths.extend(sorted(glob.glob(pattern)))
+    return paths
+
+
+SUMMARY_FIELDS = ('snapshot', 'report', 'total_bytes', 'processes',
+                  'largest_process', 'largest_process_bytes')
+
+FLEET_PROCESS_FIELDS = ('name', 'snapshots', 'mean_bytes', 'max_bytes',
+                        'max_snapshot')
+
+
+def process_snapshot(task):
+    """Writes the report of one snapshot, in a batch worker process.
+
+    Args:
+        task: A tuple of (snapshot path, report path, write_report keyword
+                arguments, TreeBuilder backend)
+    Returns:
+        A tuple of (SUMMARY_FIELDS row, {process name: bytes}, error), where
+        error is None on success and the rest is None on failure
+    """
+    snapshot, report_path, options, backend = task
+    try:
+        builder = TreeBuilder(backend=backend)
+        with open(snapshot, 'r') as snapshot_file:
+            for record in read_records(snapshot_file):
+                builder.add_record(record)
+        root_node = builder.finish()
+        # Summarize before the HTML report prunes the tree.
+        process_bytes = collections.defaultdict(int)
+        largest = None
+        for _, node in iter_processes(root_node):
+            process_bytes[node.name] += node.area
+            if largest is None or node.area > largest.area:
+                largest = node
+        row = {
+                'snapshot': snapshot,
+                'report': report_path,
+                'total_bytes': builder.root_job.area,
+                'processes': len(builder.process_stats),
+                'largest_process': largest.name if largest else '',
+                'largest_process_bytes': largest.area if largest else 0,
+        }
+        with open(report_path, 'w') as output:
+            write_report(root_node, builder.process_stats, output,
+                         **options)
+        return row, dict(process_bytes), None
+    except Exception as e:
+        return None, None, 'Error: {}: {}'.format(snapshot, e)
+
+
+def run_batch(snapshots, output_dir, options, backend='python', jobs=None):
+    """Writes the report of each snapshot, and a summary of all of them.
+
+    The reports are written to output_dir, named after the snapshots, along
+    with summary.csv, holding a row per snapshot, and processes.csv, holding
+    the size of each process name across the fleet.
+
+    Args:
+        snapshots: The paths of the memgraph snapshots
+        output_dir: The directory to write the reports to
+        options: The write_report keyword arguments
+        backend: The TreeBuilder backend to use
+        jobs: The number of worker processes; defaults to the CPU count
+    Returns:
+        The number of snapshots that could not be processed
+    """
+    extension = options.get('format', 'html')
+    tasks = []
+    report_paths = set()
+    for snapshot in snapshots:
+        name = os.path.splitext(os.path.basename(snapshot))[0]
+        report_path = os.path.join(output_dir, name + '.' + extension)
+        if report_path in report_paths:
+            # Their reports would overwrite each other: process none of them.
+            print('Error: several snapshots are named {}'.format(name),
+                  file=sys.stderr)
+            return len(snapshots)
+        report_paths.add(report_path)
+        tasks.append((snapshot, report_path, options, backend))
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    summary = []
+    fleet = collections.defaultdict(list)
+    failures = 0
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # Results come back in order, which keeps the summaries stable.
+        for row, process_bytes, error in pool.imap(process_snapshot, tasks):
+            if error:
+                print(error, file=sys.stderr)
+                failures += 1
+                continue
+            summary.append(row)
+            for name, nbytes in process_bytes.items():
+                fleet[name].append((nbytes, row['snapshot']))
+    finally:
+        pool.close()
+        pool.join()
+
+    with open(os.path.join(output_dir, 'summary.csv'), 'w') as output:
+        write_csv(summary, SUMMARY_FIELDS, output)
+
+    def fleet_rows():
+        for name, sizes in sorted(fleet.items()):
+            max_bytes, max_snapshot = max(sizes)
+            yield {
+                    'name': name,
+                    'snapshots': len(sizes),
+                    'mean_bytes': sum(n for n, _ in sizes) // len(sizes),
+                    'max_bytes': max_bytes,
+                    'max_snapshot': max_snapshot,
+            }
+    with open(os.path.join(output_dir, 'processes.csv'), 'w') as output:
+        write_csv(fleet_rows(), FLEET_PROCESS_FIELDS, output)
+    return failures
+
+
+# The Node types of the budgets of each kind.
+BUDGET_TYPES = {'job': 'j', 'process': 'p', 'vmo': 'vmo'}
+
+
+class Budget(object):
+    """A limit on the bytes of the jobs, processes or VMOs matching a pattern.
+
+    Budgets are read from JSON objects like
+      {"type": "process", "glob": "root job/*/netstack", "max_bytes": 1000}
+    where "type" is "job", "process" or "vmo", and either "glob" or "regex"
+    selects the Nodes. Jobs and processes are matched by their path of job
+    and process names joined by "/", and each matching one must fit in the
+    budget. VMOs are matched by name, without the "[n]" suffix of
+    aggregates, and their total across all processes must fit.
+    """
+
+    def __init__(self, spec):
+        if not isinstance(spec, dict):
+            raise ValueError('Budget {} is not an object'.format(
+                    json.dumps(spec)))
+        if spec.get('type') not in BUDGET_TYPES:
+            raise ValueError('Budget {} has no valid type, expected one of '
+                             '{}'.format(json.dumps(spec),
+                                         ', '.join(sorted(BUDGET_TYPES))))
+        if ('glob' in spec) == ('regex' in spec):
+            raise ValueError('Budget {} needs exactly one of "glob" and '
+                             '"regex"'.format(json.dumps(spec)))
+        if 'max_bytes' not in spec:
+            raise ValueError('Budget {} has no "max_bytes"'.format(
+                    json.dumps(spec)))
+        self.type = spec['type']
+        self.pattern = spec.get('glob', spec.get('regex'))
+        if 'glob' in spec:
+            self.matcher = re.compile(fnmatch.translate(spec['glob']))
+        else:
+            try:
+                self.matcher = re.compile(spec['regex'])
+            except re.error as e:
+                raise ValueError('Budget {} has an invalid "regex": {}'.format(
+                        json.dumps(spec), e))
+        self.max_bytes = spec['max_bytes']
+        self.total = 0
+
+    def describe(self):
+        return '{} budget "{}" of {}'.format(self.type, self.pattern,
+                                            format_size(self.max_bytes))
+
+
+def load_budgets(path):
+    """Returns the Budgets of a JSON file holding a list of budget objects."""
+    with open(path, 'r') as budgets_file:
+        specs = json.load(budgets_file)
+    if not isinstance(specs, list):
+        raise ValueError('Budgets must be a list of objects')
+    return [Budget(spec) for spec in specs]
+
+
+def check_budgets(root_node, budgets):
+    """Checks a tree against budgets in a single walk.
+
+    Whether a budget matches a given path or name is only computed once, as
+    many processes share names.
+
+    Args:
+        root_node: The root of a tree built by TreeBuilder
+        budgets: A list of Budgets
+    Returns:
+        A list of violation messages, in tree order
+    """
+    by_type = collections.defaultdict(list)
+    for budget in budgets:
+        by_type[BUDGET_TYPES[budget.type]].append(budget)
+        budget.total = 0
+    matches = {}
+
+    def matching(node_type, key):
+        cache_key = (node_type, key)
+        result = matches.get(cache_key)
+        if result is None:
+            result = [b for b in by_type[node_type] if b.matcher.match(key)]
+            matches[cache_key] = result
+        return result
+
+    violations = []
+    stack = [([], root_node)]
+    while stack:
+        names, node = stack.pop()
+        if node.type in ('j', 'p'):
+            names = names + [node.name]
+            path = '/'.join(names)
+            for budget in matching(node.type, path):
+                if node.area > budget.max_bytes:
+                    violations.append(
+                            '{} (koid {}) uses {}, over the {}'.format(
+                                    path, node.koid, format_size(node.area),
+                                    budget.describe()))
+        elif node.type == 'vmo':
+            for budget in matching('vmo', AGGREGATE_SUFFIX.sub('', node.name)):
+                budget.total += node.area
+            # Aggregated VMOs are already counted by their parent.
+            continue
+        for child in reversed(node.children):
+            stack.append((names, child))
+    for budget in by_type['vmo']:
+        if budget.total > budget.max_bytes:
+            violations.append('VMOs use {}, over the {}'.format(
+                    format_size(budget.total), budget.describe()))
+    return violations
+
+
+def check_main(argv):
+    parser = argparse.ArgumentParser(
+            prog='treemap.py check',
+            description='Checks a memgraph snapshot against memory budgets')
+    parser.add_argument('--budgets', required=True,
+                        help='JSON file holding a list of budgets; see '
+                             'treemap.Budget')
+    parser.add_argument('--backend', choices=('python', 'numpy'),
+                        default='python',
+                        help='How to aggregate the VMOs of processes')
+    parser.add_argument('snapshot', nargs='?',
+                        help='The memgraph snapshot; defaults to stdin')
+    args = parser.parse_args(argv)
+
+    try:
+        budgets = load_budgets(args.budgets)
+    except ValueError as e:
+        print('Error: {}: {}'.format(args.budgets, e), file=sys.stderr)
+        return 2
+    if args.snapshot:
+        with open(args.snapshot, 'r') as snapshot:
+            root_node = build_tree(read_records(snapshot),
+                                   backend=args.backend)
+    else:
+        root_node = build_tree(read_records(sys.stdin), backend=args.backend)
+    violations = check_budgets(root_node, budgets)
+    for violation in violations:
+        print('Error: {}'.format(violation))
+    return 1 if violations else 0
 
 
 def main():
-    root_node = build_tree(json.load(sys.stdin))
-    print_html_document(root_node)
+    if len(sys.argv) > 1 and sys.argv[1] == 'check':
+        return check_main(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(
+            description='Visualizes the output of the memgraph tool')
+    parser.add_argument('--backend', choices=('python', 'numpy'),
+                        default='python',
+                        help='How to aggregate the VMOs of processes; numpy '
+                             'is faster on large dumps')
+    parser.add_argument('--diff', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Compare two memgraph snapshots instead of '
+                             'visualizing the one on stdin')
+    parser.add_argument('--lazy', type=int, metavar='N', default=0,
+                        help='Embed the tree once as compact JSON and only '
+                             'render table rows on expand, N children at a '
+                             'time; keeps reports of large dumps small')
+    parser.add_argument('--min-bytes', type=int, default=0,
+                        help='Fold the nodes smaller than this many bytes '
+                             'into an "other" node under their parent')
+    parser.add_argument('--top-n-per-parent', type=int, default=0,
+                        help='Only show the N largest children of each node, '
+                             'folding the others into an "other" node')
+    parser.add_argument('--format', choices=('html', 'csv', 'jsonl'),
+                        default='html',
+                        help='Print an HTML document, or one of the flat '
+                             'reports chosen by --report as CSV or JSON Lines')
+    parser.add_argument('--report', choices=('processes', 'vmo-names', 'jobs'),
+                        default='processes',
+                        help='The flat report to print: the PSS, private and '
+                             'shared bytes of each process, the VMO bytes '
+                             'summed by name, or the bytes of each job')
+    parser.add_argument('--batch', nargs='+', metavar='SNAPSHOTS',
+                        help='Directories or globs of snapshots to write a '
+                             'report of each, plus fleet-wide summaries, to '
+                             '--output-dir')
+    parser.add_argument('--output-dir', default='.',
+                        help='Where --batch writes its reports')
+    parser.add_argument('--jobs', '-j', type=int,
+                        help='Number of --batch worker processes; defaults to '
+                             'the number of CPUs')
+    args = parser.parse_args()
+    options = {
+            'format': args.format,
+            'report': args.report,
+            'page_size': args.lazy,
+            'min_bytes': args.min_bytes,
+            'top_n_per_parent': args.top_n_per_parent,
+    }
+
+    if args.batch:
+        snapshots = find_snapshots(args.batch)
+        if not snapshots:
+            print('Error: no snapshots match {}'.format(' '.join(args.batch)),
+                  file=sys.stderr)
+            return 1
+        failures = run_batch(snapshots, args.output_dir, options,
+                             backend=args.backend, jobs=args.jobs)
+        return 1 if failures else 0
+
+    if args.diff:
+        roots = []
+        for path in args.diff:
+            with open(path, 'r') as snapshot:
+                roots.append(build_tree(read_records(snapshot),
+                                        backend=args.backend))
+        changes, growth_root = diff_trees(*roots)
+        prune_tree(growth_root, args.min_bytes, args.top_n_per_parent)
+        print_html_document(growth_root, title='Memory growth',
+                            table_lines=dump_html_diff_table(changes))
+        return 0
+
+    builder = TreeBuilder(backend=args.backend)
+    for record in read_records(sys.stdin):
+        builder.add_record(record)
+    write_report(builder.finish(), builder.process_stats, sys.stdout,
+                 **options)
+    return 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -4,14 +4,43 @@
 # found in the LICENSE file.
 
 import argparse
+import collections
 import contextlib
+import copy
 import errno
+import functools
+import gzip
+import hashlib
 import json
+import multiprocessing
+import multiprocessing.pool
 import os
 import shutil
+import struct
 import sys
 import tarfile
 import tempfile
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# The Linux ioctl cloning a file's extents into another file (_IOW(0x94, 9,
+# int)), supported by copy-on-write filesystems like btrfs and XFS.
+FICLONE = 0x40049409
+
+# How many links are followed when resolving a path within an archive, as
+# with the kernel's limit on symlink chains.
+MAX_ARCHIVE_LINKS = 40
 
 
 @contextlib.contextmanager
@@ -34,8 +63,150 @@ def _open_archive(archive, directory):
         raise Exception('Error: archive or directory must be set')
 
 
+def _gf2_matrix_times(matrix, vector):
+    total = 0
+    row = 0
+    while vector:
+        if vector & 1:
+            total ^= matrix[row]
+        vector >>= 1
+        row += 1
+    return total
+
+
+def _gf2_matrix_square(matrix):
+    return [_gf2_matrix_times(matrix, row) for row in matrix]
+
+
+def _crc32_combine(crc_one, crc_two, length_two):
+    '''Returns the CRC-32 of two concatenated blocks of data, given the CRC-32
+    of each block and the length of the second one.
+
+    This is zlib's crc32_combine, which Python's zlib module does not expose.
+    '''
+    if not length_two:
+        return crc_one
+    # The operator shifting a CRC by one zero bit, then by two and four.
+    odd = [0xedb88320] + [1 << n for n in range(31)]
+    even = _gf2_matrix_square(odd)
+    odd = _gf2_matrix_square(even)
+    # Shift crc_one by length_two zero bytes, squaring the operator to shift
+    # by each successive power of two.
+    while True:
+        even = _gf2_matrix_square(odd)
+        if length_two & 1:
+            crc_one = _gf2_matrix_times(even, crc_one)
+        length_two >>= 1
+        if not length_two:
+            break
+        odd = _gf2_matrix_square(even)
+        if length_two & 1:
+            crc_one = _gf2_matrix_times(odd, crc_one)
+        length_two >>= 1
+        if not length_two:
+            break
+    return crc_one ^ crc_two
+
+
+class _ParallelGzipWriter(object):
+    '''A file object compressing its contents on a pool of threads.
+
+    Like pigz, the data is cut into blocks which are deflated independently
+    and end on a sync flush, so that their outputs can be concatenated into
+    the deflate stream of a single gzip member. The CRC-32 of each block is
+    computed along with its compression and combined into the member's.
+    '''
+
+    def __init__(self, fileobj, jobs, block_size=1 << 22, level=9):
+        self._fileobj = fileobj
+        self._pool = multiprocessing.pool.ThreadPool(jobs)
+        self._block_size = block_size
+        self._level = level
+        self._buffer = []
+        self._buffered = 0
+        # Blocks being compressed, in order. Bounded to limit memory use.
+        self._pending = collections.deque()
+        self._max_pending = 2 * jobs
+        self._crc = 0
+        self._size = 0
+        mtime = struct.pack('<I', int(time.time()) & 0xffffffff)
+        self._fileobj.write(b'\x1f\x8b\x08\x00' + mtime + b'\x02\xff')
+
+    def _compress(self, data):
+        compressor = zlib.compressobj(self._level, zlib.DEFLATED,
+                                      -zlib.MAX_WBITS)
+        deflated = (compressor.compress(data) +
+                    compressor.flush(zlib.Z_SYNC_FLUSH))
+        return deflated, zlib.crc32(data) & 0xffffffff, len(data)
+
+    def _write_block(self):
+        deflated, crc, size = self._pending.popleft().get()
+        self._fileobj.write(deflated)
+        self._crc = _crc32_combine(self._crc, crc, size)
+        self._size += size
+
+    def _submit(self):
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        if len(self._pending) >= self._max_pending:
+            self._write_block()
+        self._pending.append(self._pool.apply_async(self._compress, (data,)))
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self._block_size:
+            self._submit()
+
+    def close(self):
+        '''Writes the remaining blocks and ends the gzip member. Does not
+        close the wrapped file.
+        '''
+        if self._buffered:
+            self._submit()
+        while self._pending:
+            self._write_block()
+        self._pool.close()
+        self._pool.join()
+        # An empty final block ends the deflate stream.
+        final = zlib.compressobj(self._level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._fileobj.write(final.flush(zlib.Z_FINISH))
+        self._fileobj.write(struct.pack('<II', self._crc,
+                                        self._size & 0xffffffff))
+
+
+# The compression formats of output archives.
+COMPRESSIONS = ['gzip', 'parallel-gzip', 'zstd']
+
+
 @contextlib.contextmanager
-def _open_output(archive, directory):
+def _create_archive(archive, compression, jobs):
+    '''Manages a tarfile writing a compressed archive.
+
+    gzip compresses on the calling thread. parallel-gzip and zstd compress on
+    jobs threads, and the tarfile can only be written sequentially.
+    '''
+    if compression == 'gzip':
+        with tarfile.open(archive, 'w:gz') as archive_file:
+            yield archive_file
+        return
+    if compression == 'zstd' and not zstandard:
+        raise Exception('Error: zstd compression requires the zstandard '
+                        'module')
+    with open(archive, 'wb') as output:
+        if compression == 'zstd':
+            compressor = zstandard.ZstdCompressor(threads=jobs)
+            writer = compressor.stream_writer(output)
+        else:
+            writer = _ParallelGzipWriter(output, jobs)
+        with tarfile.open(fileobj=writer, mode='w|') as archive_file:
+            yield archive_file
+        writer.close()
+
+
+@contextlib.contextmanager
+def _open_output(archive, directory, compression='gzip', jobs=1):
     '''Manages the output of this script.'''
     if directory:
         # Remove any existing output.
@@ -46,7 +217,7 @@ def _open_output(archive, directory):
         try:
             yield temp_dir
             # Write the archive file.
-            with tarfile.open(archive, "w:gz") as archive_file:
+            with _create_archive(archive, compression, jobs) as archive_file:
                 archive_file.add(temp_dir, arcname='')
         finally:
             shutil.rmtree(temp_dir, ignore_errors=True)
@@ -54,6 +225,204 @@ def _open_output(archive, directory):
         raise Exception('Error: archive or directory must be set')
 
 
+@contextlib.contextmanager
+def _stream_archive(archive):
+    '''Manages a tarfile reading an archive sequentially.
+
+    gzip archives are decompressed with GzipFile, which unlike tarfile's
+    streaming mode reads past the first gzip member of concatenated or
+    pigz-style archives.
+    '''
+    with open(archive, 'rb') as archive_file:
+        is_gzip = archive_file.read(2) == b'\x1f\x8b'
+    if not is_gzip:
+        with tarfile.open(archive, 'r|*') as tar_file:
+            yield tar_file
+        return
+    with contextlib.closing(gzip.GzipFile(archive, 'rb')) as gzip_file, \
+         tarfile.open(fileobj=gzip_file, mode='r|') as tar_file:
+        yield tar_file
+
+
+def _member_path(member):
+    '''Returns the path of an archive member relative to the SDK root.'''
+    return os.path.normpath(member.name.lstrip('/'))
+
+
+def _link_target(member):
+    '''Returns the path a link member points to, relative to the SDK root.
+
+    Symbolic links are relative to the directory holding them, hard links to
+    the root of the archive.
+    '''
+    if member.issym():
+        return os.path.normpath(os.path.join(
+                os.path.dirname(_member_path(member)), member.linkname))
+    return os.path.normpath(member.linkname.lstrip('/'))
+
+
+def _resolve_member(files, links, path):
+    '''Follows the links leading to a path within an archive.
+
+    Links may point to files as well as to directories holding the path.
+    Returns the path of the file member holding the data of the given path,
+    or None if the path does not lead to a file of the archive.
+    '''
+    for _ in range(MAX_ARCHIVE_LINKS):
+        if path in files:
+            return path
+        components = path.split(os.sep)
+        for index in range(1, len(components) + 1):
+            target = links.get(os.sep.join(components[:index]))
+            if target is not None:
+                path = os.path.normpath(os.path.join(target,
+                                                     *components[index:]))
+                break
+        else:
+            return None
+    return None
+
+
+@contextlib.contextmanager
+def _open_archive_metadata(archive):
+    '''Manages a directory holding the metadata files of an SDK archive.
+
+    Only the JSON files of the archive - its manifest and element metadata -
+    are extracted, in a single pass over the archive. Links are recreated in
+    the directory so that metadata may be read through them.
+    Yields the directory along with a function mapping a path in the archive
+    to the path of the file member holding its data, or to None if there is
+    no such file.
+    '''
+    temp_dir = tempfile.mkdtemp(prefix='fuchsia-merger')
+    try:
+        files = set()
+        links = {}
+        with _stream_archive(archive) as archive_file:
+            for member in archive_file:
+                if member.issym() or member.islnk():
+                    path = _member_path(member)
+                    target = _link_target(member)
+                    links[path] = target
+                    # Only recreate links staying within the archive.
+                    if target.startswith(os.pardir) or os.path.isabs(target):
+                        continue
+                    destination = os.path.join(temp_dir, path)
+                    _ensure_directory(destination)
+                    if member.issym():
+                        os.symlink(member.linkname, destination)
+                    elif os.path.exists(os.path.join(temp_dir, target)):
+                        os.link(os.path.join(temp_dir, target), destination)
+                    continue
+                if not member.isfile():
+                    continue
+                path = _member_path(member)
+                files.add(path)
+                if path.endswith('.json'):
+                    destination = os.path.join(temp_dir, path)
+                    _ensure_directory(destination)
+                    with open(destination, 'wb') as meta_file:
+                        shutil.copyfileobj(archive_file.extractfile(member),
+                                           meta_file)
+        yield temp_dir, functools.partial(_resolve_member, files, links)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+class _ArchivePlan(object):
+    '''Records which archive members make up the merged SDK.
+
+    Used in place of a _CopyEngine when merging archives into an archive:
+    the merge logic runs against the extracted metadata of the input
+    archives, and the files it would copy are then streamed from the input
+    archives to the output by write().
+    '''
+
+    def __init__(self, sources, out_dir):
+        '''Takes a list of (metadata directory, archive path, path resolver)
+        tuples describing the input archives, as yielded by
+        _open_archive_metadata, and the directory the merge writes its
+        metadata files to.
+        '''
+        self._sources = sources
+        self._out_dir = out_dir
+        # Output path -> (input archive, path of a file member in that
+        # archive).
+        self._files = {}
+        self._errors = []
+
+    def copy(self, element, source, destination):
+        '''Adds a file to the merged SDK on behalf of an SDK element.'''
+        for source_dir, archive, resolve in self._sources:
+            path = os.path.relpath(source, source_dir)
+            if path.startswith(os.pardir):
+                continue
+            member_path = resolve(path)
+            if member_path is None:
+                self._errors.append((element, path,
+                                     'no such file in %s' % archive))
+                return
+            # Like a copy, a later addition replaces an earlier one, and links
+            # are followed.
+            self._files[os.path.relpath(destination, self._out_dir)] = (
+                    archive, member_path)
+            return
+        raise Exception('Error: %s is not part of an input archive' % source)
+
+    def wait(self):
+        '''Reports the files that are missing from the input archives.
+
+        Returns True if all files were found.
+        '''
+        for element, source, error in sorted(self._errors):
+            print('Error: could not copy %s for %s: %s' % (source, element,
+                                                           error))
+        return not self._errors
+
+    def write(self, archive, compression='gzip', jobs=1):
+        '''Writes the merged SDK to an archive.
+
+        The input archives are read sequentially, and the selected members
+        are streamed to the output without being extracted. The metadata
+        files written by the merge are added last.
+        '''
+        selected = {}
+        for destination, (source_archive, path) in self._files.iteritems():
+            selected.setdefault(source_archive, {}).setdefault(
+                    path, []).append(destination)
+        with _create_archive(archive, compression, jobs) as output:
+            for _, source_archive, _ in self._sources:
+                wanted = selected.get(source_archive)
+                if not wanted:
+                    continue
+                with _stream_archive(source_archive) as input_file:
+                    for member in input_file:
+                        if not member.isfile():
+                            continue
+                        destinations = wanted.get(_member_path(member))
+                        if not destinations:
+                            continue
+                        data = input_file.extractfile(member)
+                        if len(destinations) > 1:
+                            # The input can only be read once: buffer the
+                            # member when it has several destinations.
+                            buffer = tempfile.TemporaryFile()
+                            shutil.copyfileobj(data, buffer)
+                            data = buffer
+                        with contextlib.closing(data):
+                            for destination in sorted(destinations):
+                                info = copy.copy(member)
+                                info.name = destination
+                                data.seek(0)
+                                output.addfile(info, data)
+            for path, directories, files in os.walk(self._out_dir):
+                directories.sort()
+                for file in sorted(files):
+                    source = os.path.join(path, file)
+                    output.add(source,
+                               arcname=os.path.relpath(source, self._out_dir))
+
+
 def _get_manifest(sdk_dir):
     '''Returns the set of elements in the given SDK.'''
     with open(os.path.join(sdk_dir, 'meta', 'manifest.json'), 'r') as manifest:
@@ -125,45 +494,313 @@ def _ensure_directory(path):
             raise
 
 
-def _copy_file(file, source_dir, dest_dir):
+def _remove_destination(destination):
+    '''Removes a file about to be replaced.
+
+    An existing destination may be a hard link to an input file, which must
+    not be truncated by opening it for writing.
+    '''
+    if os.path.lexists(destination):
+        os.remove(destination)
+
+
+def _reflink_file(source, destination):
+    '''Copies a file as a copy-on-write clone of the source.'''
+    if not fcntl:
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported here')
+    with open(source, 'rb') as source_file:
+        _remove_destination(destination)
+        descriptor = os.open(destination,
+                             os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        with os.fdopen(descriptor, 'wb') as destination_file:
+            try:
+                fcntl.ioctl(destination_file.fileno(), FICLONE,
+                            source_file.fileno())
+            except (IOError, OSError):
+                # Don't leave an empty file behind.
+                os.remove(destination)
+                raise
+    shutil.copystat(source, destination)
+
+
+def _hardlink_file(source, destination):
+    '''Copies a file as a hard link to the source.'''
+    _remove_destination(destination)
+    os.link(source, destination)
+
+
+def _link_or_copy_file(source, destination):
+    '''Copies a file as a reflink or a hard link if possible, or as a plain
+    copy otherwise.
+    '''
+    try:
+        _reflink_file(source, destination)
+        return
+    except (IOError, OSError):
+        pass
+    try:
+        _hardlink_file(source, destination)
+        return
+    except OSError:
+        pass
+    _remove_destination(destination)
+    shutil.copy2(source, destination)
+
+
+# The functions copying files in the various --link-mode modes.
+_COPY_FUNCTIONS = {
+    'copy': shutil.copy2,
+    'hardlink': _hardlink_file,
+    'reflink': _reflink_file,
+    'auto': _link_or_copy_file,
+}
+
+
+class _CopyEngine(object):
+    '''Copies files on a bounded pool of threads.
+
+    Directories are created on the calling thread, and only once each. Copy
+    failures do not interrupt the merge: they are recorded along with the
+    element being copied, and reported by wait().
+    Copies to the same destination are run one after the other, in the order
+    they were scheduled, so that the last one wins as in a serial merge.
+    '''
+
+    def __init__(self, jobs, link_mode='copy'):
+        self._pool = multiprocessing.pool.ThreadPool(jobs) if jobs > 1 else None
+        self._copy_file = _COPY_FUNCTIONS[link_mode]
+        self._directories = set()
+        self._copies = []
+        self._destinations = {}
+
+    def _ensure_directory(self, path):
+        target_dir = os.path.dirname(path)
+        if target_dir not in self._directories:
+            _ensure_directory(path)
+            self._directories.add(target_dir)
+
+    def copy(self, element, source, destination):
+        '''Schedules the copy of a file on behalf of an SDK element.'''
+        try:
+            self._ensure_directory(destination)
+        except OSError as exception:
+            self._copies.append((element, source, exception))
+            return
+        if self._pool:
+            previous = self._destinations.get(destination)
+            if previous is not None:
+                previous.wait()
+            result = self._pool.apply_async(self._copy_file,
+                                            (source, destination))
+            self._destinations[destination] = result
+        else:
+            try:
+                self._copy_file(source, destination)
+                result = None
+            except (IOError, OSError) as exception:
+                result = exception
+        self._copies.append((element, source, result))
+
+    def wait(self):
+        '''Waits for all the scheduled copies and reports the failed ones.
+
+        Failures are printed sorted by element and file, regardless of the
+        order in which the copies completed.
+        Returns True if all copies succeeded.
+        '''
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+        errors = []
+        for element, source, result in self._copies:
+            if result is not None and not isinstance(result, Exception):
+                try:
+                    result.get()
+                    result = None
+                except (IOError, OSError) as exception:
+                    result = exception
+            if result is not None:
+                errors.append((element, source, str(result)))
+        self._copies = []
+        self._destinations = {}
+        for element, source, error in sorted(errors):
+            print('Error: could not copy %s for %s: %s' % (source, element,
+                                                           error))
+        return not errors
+
+
+def _copy_file(file, source_dir, dest_dir, engine, element):
     '''Copies a file to a given path, taking care of creating directories if
     needed.
     '''
     source = os.path.join(source_dir, file)
     destination = os.path.join(dest_dir, file)
-    _ensure_directory(destination)
-    shutil.copy2(source, destination)
+    engine.copy(element, source, destination)
 
 
-def _copy_files(files, source_dir, dest_dir):
+def _copy_files(files, source_dir, dest_dir, engine, element):
     '''Copies a set of files to a given directory.'''
-    for file in files:
-        _copy_file(file, source_dir, dest_dir)
+    for file in sorted(files):
+        _copy_file(file, source_dir, dest_dir, engine, element)
+
+
+def _hash_file(path):
+    '''Returns the SHA-256 digest of a file.'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _try_hash_file(path):
+    '''Returns the SHA-256 digest of a file and None, or None and the reason
+    the file could not be read.
+    '''
+    try:
+        return _hash_file(path), None
+    except (IOError, OSError) as exception:
+        return None, exception.strerror
+
+
+class _FileVerifier(object):
+    '''Compares the contents of files across the two SDKs.
+
+    Files of different sizes are known to differ without being read. Others
+    are hashed on a pool of threads, and their hashes are kept in a JSON
+    cache indexed by SDK and path, along with the size and modification time
+    they are valid for. An SDK's hashes are dropped when its stamp changes.
+    '''
+
+    def __init__(self, jobs, cache_path=None):
+        self._pool = multiprocessing.pool.ThreadPool(jobs)
+        self._cache_path = cache_path
+        # SDK directory -> name of the SDK in the cache.
+        self._names = {}
+        # SDK name -> {'stamp': stamp, 'files': path -> [size, mtime, hash]}.
+        self._cache = {}
+        self._dirty = False
+        if cache_path and os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'r') as cache_file:
+                    self._cache = json.load(cache_file)
+            except ValueError:
+                print('Warning: ignoring invalid hash cache ' + cache_path)
+
+    def add_sdk(self, directory, name, stamp=None):
+        '''Registers the stable name of an SDK laid out in a directory, under
+        which the hashes of its files are cached.
+
+        The stamp identifies the version of an SDK whose files may not carry
+        meaningful modification times, like the size and modification time
+        of the archive it was extracted from.
+        '''
+        self._names[directory] = name
+        sdk = self._cache.get(name)
+        if not sdk or sdk.get('stamp') != stamp:
+            self._cache[name] = {'stamp': stamp, 'files': {}}
+            self._dirty = True
+
+    def find_different_files(self, files, source_dir_one, source_dir_two):
+        '''Returns the sorted list of the files which differ between two
+        directories, as (file, reason) tuples.
+        '''
+        different = set()
+        to_hash = []
+        for file in sorted(files):
+            stats = []
+            for source_dir in (source_dir_one, source_dir_two):
+                try:
+                    stat = os.stat(os.path.join(source_dir, file))
+                except OSError as exception:
+                    different.add((file, 'cannot be read from %s: %s' % (
+                            self._names[source_dir], exception.strerror)))
+                    break
+                stats.append((source_dir, stat.st_size, stat.st_mtime))
+            else:
+                if stats[0][1] != stats[1][1]:
+                    different.add((file, 'differs between the two SDKs'))
+                else:
+                    to_hash.append((file, stats))
+
+        hashes = {}
+        missing = []
+        for file, stats in to_hash:
+            for source_dir, size, mtime in stats:
+                entry = self._cache[self._names[source_dir]]['files'].get(file)
+                if entry and entry[0] == size and entry[1] == mtime:
+                    hashes[(source_dir, file)] = entry[2]
+                else:
+                    missing.append((source_dir, file, size, mtime))
+        computed = self._pool.map(
+                _try_hash_file,
+                [os.path.join(source_dir, file)
+                 for source_dir, file, _, _ in missing])
+        unreadable = set()
+        for (source_dir, file, size, mtime), (digest, error) in zip(missing,
+                                                                    computed):
+            if error is not None:
+                if file in unreadable:
+                    continue
+                different.add((file, 'cannot be read from %s: %s' % (
+                        self._names[source_dir], error)))
+                unreadable.add(file)
+                continue
+            hashes[(source_dir, file)] = digest
+            self._cache[self._names[source_dir]]['files'][file] = [
+                    size, mtime, digest]
+            self._dirty = True
+
+        for file, _ in to_hash:
+            if file in unreadable:
+                continue
+            if (hashes[(source_dir_one, file)] !=
+                    hashes[(source_dir_two, file)]):
+                different.add((file, 'differs between the two SDKs'))
+        return sorted(different)
+
+    def close(self):
+        '''Stops the hashing threads and saves the hash cache.'''
+        self._pool.close()
+        self._pool.join()
+        if not self._cache_path or not self._dirty:
+            return
+        temp_path = self._cache_path + '.tmp'
+        with open(temp_path, 'w') as cache_file:
+            json.dump(self._cache, cache_file, sort_keys=True)
+        os.rename(temp_path, self._cache_path)
 
 
 def _copy_identical_files(set_one, source_dir_one, set_two, source_dir_two,
-                          dest_dir):
+                          dest_dir, engine, element, verifier=None):
     '''Verifies that two sets of files are absolutely identical and then copies
     them to the output directory.
     '''
     if set_one != set_two:
         return False
-    # Not verifying that the contents of the files are the same, as builds are
-    # not exactly stable at the moment.
-    _copy_files(set_one, source_dir_one, dest_dir)
+    # Only verifying that the contents of the files are the same when asked
+    # to, as builds are not exactly stable at the moment.
+    if verifier:
+        different = verifier.find_different_files(set_one, source_dir_one,
+                                                  source_dir_two)
+        for file, reason in different:
+            print('Error: %s %s' % (file, reason))
+        if different:
+            return False
+    _copy_files(set_one, source_dir_one, dest_dir, engine, element)
     return True
 
 
-def _copy_element(element, source_dir, dest_dir):
+def _copy_element(element, source_dir, dest_dir, engine):
     '''Copy an entire SDK element to a given directory.'''
     meta = _get_meta(element, source_dir)
     common_files, arch_files = _get_files(meta)
     files = common_files
     for more_files in arch_files.itervalues():
         files.update(more_files)
-    _copy_files(files, source_dir, dest_dir)
+    _copy_files(files, source_dir, dest_dir, engine, element)
     # Copy the metadata file as well.
-    _copy_file(element, source_dir, dest_dir)
+    _copy_file(element, source_dir, dest_dir, engine, element)
 
 
 def _write_meta(element, source_dir_one, source_dir_two, dest_dir):
@@ -231,6 +868,76 @@ def _write_manifest(source_dir_one, source_dir_two, dest_dir):
     return True
 
 
+def _merge(alpha_dir, beta_dir, out_dir, engine, verifier=None):
+    '''Merges the SDKs laid out in two directories into a third one.
+
+    Files are copied through the given engine. If a verifier is given, the
+    files expected to be identical in both SDKs are compared. Returns True if
+    the merge encountered errors.
+    '''
+    has_errors = False
+
+    alpha_elements = set(_get_manifest(alpha_dir)['parts'])
+    beta_elements = set(_get_manifest(beta_dir)['parts'])
+    common_elements = alpha_elements & beta_elements
+
+    # Copy elements that appear in a single SDK.
+    for element in sorted(alpha_elements - common_elements):
+        _copy_element(element, alpha_dir, out_dir, engine)
+    for element in sorted(beta_elements - common_elements):
+        _copy_element(element, beta_dir, out_dir, engine)
+
+    # Verify and merge elements which are common to both SDKs.
+    for element in sorted(common_elements):
+        alpha_meta = _get_meta(element, alpha_dir)
+        beta_meta = _get_meta(element, beta_dir)
+        alpha_common, alpha_arch = _get_files(alpha_meta)
+        beta_common, beta_arch = _get_files(beta_meta)
+
+        # Common files should not vary.
+        if not _copy_identical_files(alpha_common, alpha_dir, beta_common,
+                                     beta_dir, out_dir, engine, element,
+                                     verifier):
+            print('Error: different common files for ' + element)
+            has_errors = True
+            continue
+
+        # Arch-dependent files need to be merged in the metadata.
+        all_arches = set(alpha_arch.keys()) | set(beta_arch.keys())
+        for arch in all_arches:
+            if arch in alpha_arch and arch in beta_arch:
+                if not _copy_identical_files(alpha_arch[arch], alpha_dir,
+                                             beta_arch[arch], beta_dir,
+                                             out_dir, engine, element,
+                                             verifier):
+                    print('Error: different %s files for %s' % (arch,
+                                                               element))
+                    has_errors = True
+                    continue
+            elif arch in alpha_arch:
+                _copy_files(alpha_arch[arch], alpha_dir, out_dir, engine,
+                            element)
+            elif arch in beta_arch:
+                _copy_files(beta_arch[arch], beta_dir, out_dir, engine,
+                            element)
+
+        if not _write_meta(element, alpha_dir, beta_dir, out_dir):
+            print('Error: unable to merge meta for ' + element)
+            has_errors = True
+
+    if not _write_manifest(alpha_dir, beta_dir, out_dir):
+        print('Error: could not write manifest file')
+        has_errors = True
+
+    # TODO(DX-495): verify that metadata files are valid.
+
+    # All files must be in place before the output archive is written.
+    if not engine.wait():
+        has_errors = True
+
+    return has_errors
+
+
 def main():
     parser = argparse.ArgumentParser(
             description=('Merges the contents of two SDKs'))
@@ -255,63 +962,99 @@ def main():
     output_group.add_argument('--output-directory',
                               help='Path to the merged SDK - as a directory',
                               default='')
+    parser.add_argument('--jobs', '-j',
+                        help='Number of files to copy in parallel',
+                        type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--link-mode',
+                        help='How to copy files to the output: as plain '
+                             'copies, hard links, or copy-on-write reflinks; '
+                             '"auto" tries reflinks, then hard links, then '
+                             'plain copies. Linked files share their '
+                             'contents with the input SDKs',
+                        choices=sorted(_COPY_FUNCTIONS),
+                        default='copy')
+    parser.add_argument('--streaming',
+                        help='When merging two archives into an archive, '
+                             'stream files from the inputs to the output '
+                             'instead of extracting the inputs to disk',
+                        action='store_true')
+    parser.add_argument('--compression',
+                        help='How to compress the output archive: gzip on a '
+                             'single thread, gzip on --jobs threads (as a '
+                             'single gzip member readable by any gzip '
+                             'decoder), or zstd on --jobs threads, which '
+                             'requires the zstandard module',
+                        choices=COMPRESSIONS,
+                        default='gzip')
+    parser.add_argument('--verify',
+                        help='Verify that the files expected to be identical '
+                             'in both SDKs have the same contents',
+                        action='store_true')
+    parser.add_argument('--hash-cache',
+                        help='Path to a file caching the hashes computed by '
+                             '--verify across runs')
     args = parser.parse_args()
 
+    if args.compression == 'zstd' and not zstandard:
+        print('Error: zstd compression requires the zstandard module')
+        return 1
+    if args.verify and args.streaming:
+        print('Error: --verify requires extracting the input archives and '
+              'cannot be used with --streaming')
+        return 1
+
     has_errors = False
 
+    if args.streaming:
+        if not (args.alpha_archive and args.beta_archive and
+                args.output_archive):
+            print('Error: --streaming requires archive inputs and output')
+            return 1
+        with _open_archive_metadata(args.alpha_archive) as (alpha_dir,
+                                                            alpha_resolve), \
+             _open_archive_metadata(args.beta_archive) as (beta_dir,
+                                                           beta_resolve):
+            out_dir = tempfile.mkdtemp(prefix='fuchsia-merger')
+            try:
+                plan = _ArchivePlan([
+                    (alpha_dir, args.alpha_archive, alpha_resolve),
+                    (beta_dir, args.beta_archive, beta_resolve),
+                ], out_dir)
+                has_errors = _merge(alpha_dir, beta_dir, out_dir, plan)
+                plan.write(args.output_archive, args.compression, args.jobs)
+            finally:
+                shutil.rmtree(out_dir, ignore_errors=True)
+        return 1 if has_errors else 0
+
     with _open_archive(args.alpha_archive, args.alpha_directory) as alpha_dir, \
          _open_archive(args.beta_archive, args.beta_directory) as beta_dir, \
-         _open_output(args.output_archive, args.output_directory) as out_dir:
-
-        alpha_elements = set(_get_manifest(alpha_dir)['parts'])
-        beta_elements = set(_get_manifest(beta_dir)['parts'])
-        common_elements = alpha_elements & beta_elements
-
-        # Copy elements that appear in a single SDK.
-        for element in sorted(alpha_elements - common_elements):
-            _copy_element(element, alpha_dir, out_dir)
-        for element in (beta_elements - common_elements):
-            _copy_element(element, beta_dir, out_dir)
-
-        # Verify and merge elements which are common to both SDKs.
-        for element in sorted(common_elements):
-            alpha_meta = _get_meta(element, alpha_dir)
-            beta_meta = _get_meta(element, beta_dir)
-            alpha_common, alpha_arch = _get_files(alpha_meta)
-            beta_common, beta_arch = _get_files(beta_meta)
-
-            # Common files should not vary.
-            if not _copy_identical_files(alpha_common, alpha_dir, beta_common,
-                                         beta_dir, out_dir):
-                print('Error: different common files for ' + element)
-                has_errors = True
-                continue
-
-            # Arch-dependent files need to be merged in the metadata.
-            all_arches = set(alpha_arch.keys()) | set(beta_arch.keys())
-            for arch in all_arches:
-                if arch in alpha_arch and arch in beta_arch:
-                    if not _copy_identical_files(alpha_arch[arch], alpha_dir,
-                                                 beta_arch[arch], beta_dir,
-                                                 out_dir):
-                        print('Error: different %s files for %s' % (arch,
-                                                                   element))
-                        has_errors = True
-                        continue
-                elif arch in alpha_arch:
-                    _copy_files(alpha_arch[arch], alpha_dir, out_dir)
-                elif arch in beta_arch:
-                    _copy_files(beta_arch[arch], beta_dir, out_dir)
-
-            if not _write_meta(element, alpha_dir, beta_dir, out_dir):
-                print('Error: unable to merge meta for ' + element)
-                has_errors = True
+         _open_output(args.output_archive, args.output_directory,
+                      args.compression, args.jobs) as out_dir:
 
-        if not _write_manifest(alpha_dir, beta_dir, out_dir):
-            print('Error: could not write manifest file')
-            has_errors = True
-
-        # TODO(DX-495): verify that metadata files are valid.
+        engine = _CopyEngine(args.jobs, args.link_mode)
+        verifier = None
+        if args.verify:
+            verifier = _FileVerifier(args.jobs, args.hash_cache)
+            # Name the SDKs after their inputs rather than after the
+            # temporary directories archives are extracted to. The files of
+            # an archive keep the modification times recorded in it, which
+            # reproducible builds pin, so the archive itself is stamped.
+            for directory, archive, sdk_directory in (
+                    (alpha_dir, args.alpha_archive, args.alpha_directory),
+                    (beta_dir, args.beta_archive, args.beta_directory)):
+                stamp = None
+                if archive:
+                    stat = os.stat(archive)
+                    stamp = [stat.st_size, stat.st_mtime]
+                verifier.add_sdk(directory,
+                                 os.path.abspath(archive or sdk_directory),
+                                 stamp)
+        try:
+            has_errors = _merge(alpha_dir, beta_dir, out_dir, engine, verifier)
+        finally:
+            if verifier:
+                verifier.close()
 
     return 1 if has_errors else 0
 